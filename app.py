@@ -1,59 +1,183 @@
-from flask import Flask
-import os
+import asyncio
 import logging
-import subprocess
-import threading
+import os
+import signal
+import sys
 import time
+from typing import List, Optional
+
+from aiohttp import web
 
-app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def run_bot_subprocess():
-    """Run bot as subprocess and auto-restart"""
-    while True:
+APP_PORT = int(os.getenv('APP_PORT', '5000'))
+# Restart delay doubles after each crash, up to the maximum; a run longer than
+# BACKOFF_RESET_AFTER seconds counts as healthy and resets it
+BACKOFF_MIN = float(os.getenv('BACKOFF_MIN', '1'))
+BACKOFF_MAX = float(os.getenv('BACKOFF_MAX', '300'))
+BACKOFF_RESET_AFTER = float(os.getenv('BACKOFF_RESET_AFTER', '60'))
+# Seconds the bot gets to shut down after SIGTERM before it is killed
+STOP_TIMEOUT = float(os.getenv('STOP_TIMEOUT', '20'))
+# Longest output line passed through; longer lines are cut
+MAX_LINE_BYTES = 1024 * 1024
+
+
+class BotSupervisor:
+    """Runs the bot as a child process and restarts it when it exits.
+
+    The child's stdout and stderr are logged line by line as they arrive,
+    so nothing accumulates in memory. Crashes are retried with exponential
+    backoff; stop() forwards SIGTERM so the bot can shut down cleanly.
+    """
+
+    def __init__(self, command: List[str]):
+        self.command = command
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.started_at = time.monotonic()
+        self.child_started_at: Optional[float] = None
+        self.restarts = 0
+        self.last_exit_code: Optional[int] = None
+        self.backoff = BACKOFF_MIN
+        self._stopping = asyncio.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def run(self) -> None:
+        """Keep the bot running until stop() is called"""
+        while not self._stopping.is_set():
+            try:
+                await self._run_once()
+            except Exception as e:
+                logger.error(f"❌ Subprocess error: {e}")
+            if self._stopping.is_set():
+                break
+
+            logger.warning(f"⚠️ Bot process ended (exit code {self.last_exit_code}), restarting in {self.backoff:g} seconds...")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.backoff)
+            except asyncio.TimeoutError:
+                pass
+            self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+            self.restarts += 1
+
+    async def _run_once(self) -> None:
+        logger.info("🤖 Starting bot subprocess...")
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            limit=MAX_LINE_BYTES
+        )
+        self.child_started_at = time.monotonic()
+        if self._stopping.is_set():
+            # stop() came while the process was starting
+            self.process.send_signal(signal.SIGTERM)
         try:
-            logger.info("🤖 Starting bot subprocess...")
-            # Run bot.py as a separate process
-            process = subprocess.run(
-                ['python', 'bot.py'],
-                capture_output=True,
-                text=True
+            await asyncio.gather(
+                self._forward(self.process.stdout, 'stdout'),
+                self._forward(self.process.stderr, 'stderr'),
             )
-            
-            if process.stdout:
-                logger.info(f"Bot output: {process.stdout}")
-            if process.stderr:
-                logger.error(f"Bot errors: {process.stderr}")
-                
-            logger.warning("⚠️ Bot process ended, restarting in 10 seconds...")
-            time.sleep(10)
-            
-        except Exception as e:
-            logger.error(f"❌ Subprocess error: {e}")
-            time.sleep(30)
-
-@app.route('/')
-def home():
-    return """
+            self.last_exit_code = await self.process.wait()
+        finally:
+            ran_for = time.monotonic() - self.child_started_at
+            self.child_started_at = None
+            if ran_for > BACKOFF_RESET_AFTER:
+                self.backoff = BACKOFF_MIN
+
+    async def _forward(self, stream: asyncio.StreamReader, name: str) -> None:
+        """Log each line of one of the child's output streams as it arrives"""
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # Longer than MAX_LINE_BYTES: asyncio drops what it buffered
+                logger.warning(f"Bot {name}: line over {MAX_LINE_BYTES} bytes cut")
+                continue
+            if not line:
+                return
+            # The bot's logging goes to stderr, so stderr isn't only errors
+            logger.info(f"[bot] {line.decode(errors='replace').rstrip()}")
+
+    async def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Stop restarting, SIGTERM the bot and kill it if it doesn't exit in time"""
+        self._stopping.set()
+        if not self.running:
+            return
+        logger.info("Stopping bot subprocess...")
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Bot did not exit within {timeout:.0f} seconds, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            'status': 'ok' if self.running else 'stopped' if self._stopping.is_set() else 'restarting',
+            'uptime_seconds': round(now - self.started_at, 1),
+            'bot_uptime_seconds': round(now - self.child_started_at, 1) if self.child_started_at else 0,
+            'restarts': self.restarts,
+            'last_exit_code': self.last_exit_code,
+            'pid': self.process.pid if self.running else None,
+        }
+
+
+def create_app(supervisor: BotSupervisor) -> web.Application:
+    async def home(request: web.Request) -> web.Response:
+        status = "🟢 RUNNING" if supervisor.running else "🟡 RESTARTING"
+        return web.Response(text=f"""
     <html>
         <head><title>HexaLegends Bot</title></head>
         <body style="text-align: center; padding: 50px;">
             <h1>🤖 HexaLegends Bot</h1>
-            <p>Status: 🟢 RUNNING</p>
-            <p>Bot runs in background with auto-restart</p>
+            <p>Status: {status}</p>
+            <p>Bot runs in background with auto-restart ({supervisor.restarts} restarts)</p>
         </body>
     </html>
-    """
+    """, content_type='text/html')
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response(supervisor.snapshot(), status=200 if supervisor.running else 503)
+
+    app = web.Application()
+    app.router.add_get('/', home)
+    app.router.add_get('/health', health)
+    return app
+
+
+async def main() -> None:
+    supervisor = BotSupervisor([sys.executable, 'bot.py'])
+    loop = asyncio.get_running_loop()
+    stop_requested = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_requested.set)
+        except NotImplementedError:
+            pass
+
+    runner = web.AppRunner(create_app(supervisor))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', APP_PORT).start()
+    logger.info(f"Supervisor listening on port {APP_PORT}")
+
+    supervising = asyncio.create_task(supervisor.run())
+    try:
+        await asyncio.wait(
+            [supervising, asyncio.create_task(stop_requested.wait())],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        await supervisor.stop()
+        await supervising
+        await runner.cleanup()
 
-@app.route('/health')
-def health():
-    return "✅ Healthy"
 
 if __name__ == '__main__':
-    # Start bot in background thread
-    bot_thread = threading.Thread(target=run_bot_subprocess, daemon=True)
-    bot_thread.start()
-    
-    # Start Flask
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    asyncio.run(main())
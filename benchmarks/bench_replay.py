@@ -0,0 +1,205 @@
+"""Update pipeline: updates per second, latency and allocations.
+
+    python benchmarks/bench_replay.py [--count 20000] [--chats 50] [--input updates.jsonl]
+
+Feeds a stream of Update JSON (one per line with --input, otherwise a
+synthetic mix of chatter, banned words, floods and joins) through the bot's
+Application, with Bot API calls answered by stub_bot_api on localhost.
+All updates are queued at once, like a raid: latency is reported both from
+the update queue and from the first handler until every handler group is
+done with it. A second pass under tracemalloc reports allocations.
+Use --save to write the synthetic stream for later replays.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from bot import AdvancedWelcomeSecurityBot
+from stub_bot_api import STUB_ADMINS, StubBotAPI
+
+TOKEN = '123456:BENCHMARK'
+BANNED_WORDS = (('spamword', 'delete'), ('scamlink', 'delete'), ('badword', 'warn'))
+CHATTER = ('hello', 'anyone', 'here', 'good', 'morning', 'what', 'about', 'the', 'match', 'tonight', 'lol', 'ok')
+
+
+def synthetic_updates(count: int, chats: int, seed: int):
+    """Mostly chatter, with banned words, flooding users and joins mixed in"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    next_user = itertools.count(10_000_000)
+    for update_id in range(1, count + 1):
+        chat_index = rng.randrange(chats)
+        chat = {'id': -1001000000000 - chat_index, 'type': 'supergroup', 'title': f"Chat {chat_index}"}
+        roll = rng.random()
+        if roll < 0.05:
+            user = {'id': next(next_user), 'is_bot': False, 'first_name': 'Newcomer'}
+            if roll < 0.025:
+                message = {'message_id': update_id, 'date': now, 'chat': chat, 'from': user, 'new_chat_members': [user]}
+                yield {'update_id': update_id, 'message': message}
+            else:
+                yield {'update_id': update_id, 'chat_member': {
+                    'chat': chat, 'from': user, 'date': now,
+                    'old_chat_member': {'status': 'left', 'user': user},
+                    'new_chat_member': {'status': 'member', 'user': user},
+                }}
+            continue
+
+        if roll < 0.12:
+            # A few users per chat post far faster than the flood limit
+            user_id = 1000 + chat_index * 10 + rng.randrange(3)
+        else:
+            user_id = 100000 + rng.randrange(500)
+        words = rng.choices(CHATTER, k=rng.randint(2, 12))
+        if roll > 0.92:
+            words.insert(rng.randrange(len(words)), rng.choice(BANNED_WORDS)[0])
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+        message = {'message_id': update_id, 'date': now, 'chat': chat, 'from': user, 'text': ' '.join(words)}
+        yield {'update_id': update_id, 'message': message}
+
+
+def load_stream(args):
+    if args.input:
+        with open(args.input) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    stream = list(synthetic_updates(args.count, args.chats, args.seed))
+    if args.save:
+        with open(args.save, 'w') as f:
+            for data in stream:
+                f.write(json.dumps(data) + '\n')
+    return stream
+
+
+async def replay(stream, base_url: str, trace: bool):
+    """Run the stream through a fresh bot.
+
+    Returns (seconds, queue-to-done latencies, handler latencies,
+    allocation stats, outbound counters).
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = AdvancedWelcomeSecurityBot(TOKEN, db_path=os.path.join(tmp, 'bench.db'), base_url=base_url)
+        application = bot.application
+        chat_ids = {data[key]['chat']['id'] for data in stream for key in ('message', 'chat_member') if key in data}
+        # Concurrently, so they share group commits
+        await asyncio.gather(*(
+            bot.storage.banned_words.add(chat_id, word, action, STUB_ADMINS[0])
+            for chat_id in chat_ids for word, action in BANNED_WORDS
+        ))
+        bot.any_banned_words = True
+
+        queued_at = {}
+        started_at = {}
+        latencies = []
+        handler_latencies = []
+        done = asyncio.Event()
+
+        async def started(update, context):
+            started_at[update.update_id] = time.perf_counter()
+
+        async def finished(update, context):
+            now = time.perf_counter()
+            latencies.append(now - queued_at[update.update_id])
+            handler_latencies.append(now - started_at[update.update_id])
+            if len(latencies) == len(stream):
+                done.set()
+        application.add_handler(TypeHandler(Update, started), group=-100)
+        application.add_handler(TypeHandler(Update, finished), group=100)
+
+        await application.initialize()
+        await application.start()
+        updates = [Update.de_json(data, application.bot) for data in stream]
+
+        allocations = None
+        if trace:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        for update in updates:
+            queued_at[update.update_id] = time.perf_counter()
+            await application.update_queue.put(update)
+        await done.wait()
+        elapsed = time.perf_counter() - start
+        if trace:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # Only what the bot and libraries hold on to, not this script's bookkeeping
+            ignore_self = [tracemalloc.Filter(False, __file__)]
+            diff = after.filter_traces(ignore_self).compare_to(before.filter_traces(ignore_self), 'lineno')
+            allocations = {
+                'blocks': sum(stat.count_diff for stat in diff if stat.count_diff > 0),
+                'bytes': sum(stat.size_diff for stat in diff if stat.size_diff > 0),
+                'peak': peak,
+                'top': [stat for stat in diff[:5]],
+            }
+
+        await application.stop()
+        outbound = bot.outbound.snapshot()
+        # Sends still waiting for Telegram's rate limits aren't part of the measurement
+        await bot.outbound.close(timeout=0)
+        while bot.outbound.in_flight:
+            await asyncio.sleep(0.01)
+        await application.shutdown()
+        await bot.post_shutdown(application)
+        return elapsed, latencies, handler_latencies, allocations, outbound
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def main_async(args):
+    stream = load_stream(args)
+    stub = StubBotAPI()
+    base_url = await stub.start(args.port)
+    try:
+        elapsed, latencies, handler_latencies, _, outbound = await replay(stream, base_url, trace=False)
+        print(f"updates          {len(stream)}")
+        print(f"throughput       {len(stream) / elapsed:12.0f} updates/s")
+        for name, values in (("queued", latencies), ("handlers", handler_latencies)):
+            print(f"{name + ' p50':<16} {percentile(values, 0.50) * 1000:12.3f} ms")
+            print(f"{name + ' p99':<16} {percentile(values, 0.99) * 1000:12.3f} ms")
+        print(f"outbound         {outbound}")
+        print(f"stub API calls   {dict(sorted(stub.calls.items()))}")
+
+        if not args.no_trace:
+            _, _, _, allocations, _ = await replay(stream, base_url, trace=True)
+            print(f"allocated        {allocations['bytes'] / len(stream):12.0f} bytes/update still held")
+            print(f"alloc blocks     {allocations['blocks'] / len(stream):12.1f} blocks/update still held")
+            print(f"traced peak      {allocations['peak'] / 1024 / 1024:12.1f} MiB")
+            for stat in allocations['top']:
+                print(f"  {stat}")
+    finally:
+        await stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--input', help="JSONL file of Update JSON to replay instead of the synthetic mix")
+    parser.add_argument('--save', help="write the synthetic stream to this JSONL file")
+    parser.add_argument('--port', type=int, default=8181, help="port of the stub Bot API")
+    parser.add_argument('--no-trace', action='store_true', help="skip the tracemalloc pass")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Welcome rendering: messages prepared per second.
+
+    python benchmarks/bench_welcome.py [--count 100000] [--buttons 6]
+
+Compares formatting the raw welcome_text with str.format and rebuilding
+the keyboard on every join against a compiled WelcomeTemplate plus a
+keyboard built once and reused.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, User
+
+from welcome_template import WelcomeTemplate
+
+WELCOME_TEXT = "👋 Welcome {mention} to <b>{group}</b>!\nYour id: <code>{id}</code>. Please read the rules, {name}."
+
+
+def build_keyboard(buttons):
+    keyboard = []
+    for btn_row in buttons:
+        row = []
+        for btn in btn_row:
+            row.append(InlineKeyboardButton(btn['text'], url=btn['url']))
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def values(user):
+    return {
+        'name': user.first_name,
+        'username': f"@{user.username}" if user.username else user.first_name,
+        'group': "Benchmark Group",
+        'mention': user.mention_html(),
+        'id': str(user.id),
+    }
+
+
+def bench_format(count, users, buttons):
+    start = time.perf_counter()
+    for i in range(count):
+        WELCOME_TEXT.format(**values(users[i % len(users)]))
+        build_keyboard(buttons)
+    return count / (time.perf_counter() - start)
+
+
+def bench_compiled(count, users, buttons):
+    template = WelcomeTemplate(WELCOME_TEXT)
+    build_keyboard(buttons)  # built once per settings change, outside the timed loop
+    start = time.perf_counter()
+    for i in range(count):
+        template.render(values(users[i % len(users)]))
+    return count / (time.perf_counter() - start)
+
+
+def bench_render_only(count, users):
+    template = WelcomeTemplate(WELCOME_TEXT)
+    prepared = [values(user) for user in users]
+    start = time.perf_counter()
+    for i in range(count):
+        template.render(prepared[i % len(prepared)])
+    return count / (time.perf_counter() - start)
+
+
+def bench_format_only(count, users):
+    prepared = [values(user) for user in users]
+    start = time.perf_counter()
+    for i in range(count):
+        WELCOME_TEXT.format(**prepared[i % len(prepared)])
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--buttons', type=int, default=6)
+    args = parser.parse_args()
+
+    users = [User(id=1000 + i, first_name=f"User{i}", is_bot=False, username=f"user{i}") for i in range(64)]
+    buttons = [
+        [{'text': f"Link {i}", 'url': f"https://example.com/{i}"}, {'text': f"Doc {i}", 'url': f"https://example.com/doc/{i}"}]
+        for i in range(max(1, args.buttons // 2))
+    ]
+
+    results = [
+        ("str.format + new keyboard", bench_format(args.count, users, buttons)),
+        ("compiled + cached keyboard", bench_compiled(args.count, users, buttons)),
+        ("str.format only", bench_format_only(args.count, users)),
+        ("compiled render only", bench_render_only(args.count, users)),
+    ]
+    for name, rate in results:
+        print(f"{name:<28} {rate:12.0f} welcomes/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Soak test: the bot polling stub_bot_api through raids, watching memory.
+
+    python benchmarks/soak.py [--duration 600] [--rate 200] [--chats 200] [--latency 0.05]
+
+Runs AdvancedWelcomeSecurityBot against StubBotAPI over real getUpdates
+long polling. Every second, --rate updates are pushed: ordinary chatter,
+plus recurring raids (a wave of joins in one chat, then a flood of banned
+words). The stub adds latency and answers with 429 RetryAfter as Telegram
+would. Every --interval seconds RSS, Python-traced memory and the bot's
+queues and caches are printed; RSS should level off, not keep climbing.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import AdvancedWelcomeSecurityBot
+from stub_bot_api import STUB_ADMINS, StubBotAPI
+
+TOKEN = '123456:SOAK'
+BANNED_WORDS = (('spamword', 'delete'), ('scamlink', 'delete'), ('badword', 'warn'))
+CHATTER = ('hello', 'anyone', 'here', 'good', 'morning', 'what', 'about', 'the', 'match', 'tonight', 'lol', 'ok')
+
+
+def rss_mb() -> float:
+    """Current resident set size (peak where /proc isn't available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+class RaidGenerator:
+    """Chatter across many chats with a raid on one of them every raid_every seconds"""
+
+    def __init__(self, chats: int, raid_every: float, raid_size: int, seed: int):
+        self.chats = chats
+        self.raid_every = raid_every
+        self.raid_size = raid_size
+        self.rng = random.Random(seed)
+        self.user_ids = itertools.count(10_000_000)
+        self.message_ids = itertools.count(1)
+        self.last_raid = time.monotonic()
+
+    def chat(self, index: int) -> dict:
+        return {'id': -1001000000000 - index, 'type': 'supergroup', 'title': f"Soak {index}"}
+
+    def message(self, chat: dict, user: dict, **fields) -> dict:
+        return {'message': dict(
+            {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': chat, 'from': user}, **fields
+        )}
+
+    def chatter(self) -> dict:
+        chat = self.chat(self.rng.randrange(self.chats))
+        user_id = 100000 + self.rng.randrange(5000)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+        return self.message(chat, user, text=' '.join(self.rng.choices(CHATTER, k=self.rng.randint(2, 12))))
+
+    def raid(self):
+        """Joins (service messages and chat_member updates), then the raiders post banned words"""
+        chat = self.chat(self.rng.randrange(self.chats))
+        raiders = [{'id': next(self.user_ids), 'is_bot': False, 'first_name': 'Raider'} for _ in range(self.raid_size)]
+        for user in raiders:
+            yield self.message(chat, user, new_chat_members=[user])
+            yield {'chat_member': {
+                'chat': chat, 'from': user, 'date': int(time.time()),
+                'old_chat_member': {'status': 'left', 'user': user},
+                'new_chat_member': {'status': 'member', 'user': user},
+            }}
+        for user in raiders:
+            for _ in range(3):
+                word = self.rng.choice(BANNED_WORDS)[0]
+                yield self.message(chat, user, text=f"join now {word} {word}")
+
+    def tick(self, rate: int):
+        """Updates for one second"""
+        updates = [self.chatter() for _ in range(rate)]
+        if time.monotonic() - self.last_raid >= self.raid_every:
+            self.last_raid = time.monotonic()
+            updates.extend(self.raid())
+        return updates
+
+
+async def soak(args):
+    stub = StubBotAPI(
+        latency=args.latency, jitter=args.latency,
+        flood_probability=args.flood_probability, enforce_limits=True, seed=args.seed
+    )
+    base_url = await stub.start(args.port)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = AdvancedWelcomeSecurityBot(TOKEN, db_path=os.path.join(tmp, 'soak.db'), base_url=base_url)
+        application = bot.application
+        generator = RaidGenerator(args.chats, args.raid_every, args.raid_size, args.seed)
+        # Concurrently, so they share group commits
+        await asyncio.gather(*(
+            bot.storage.banned_words.add(generator.chat(index)['id'], word, action, STUB_ADMINS[0])
+            for index in range(args.chats) for word, action in BANNED_WORDS
+        ))
+        bot.any_banned_words = True
+
+        if args.trace:
+            tracemalloc.start()
+        await application.initialize()
+        await bot.post_init(application)
+        bot.allowed_updates = bot.allowed_update_types()
+        await application.updater.start_polling(allowed_updates=bot.allowed_updates, poll_interval=0, timeout=1)
+        await application.start()
+
+        start = time.monotonic()
+        baseline = rss_mb()
+        pushed = 0
+        next_report = start + args.interval
+        print(f"{'t':>6} {'pushed':>8} {'backlog':>7} {'rss MiB':>8} {'traced':>7} {'outbound':>9} {'chats':>6} {'counters':>8}")
+        try:
+            while time.monotonic() - start < args.duration:
+                for update in generator.tick(args.rate):
+                    stub.push_update(update)
+                    pushed += 1
+                await asyncio.sleep(1)
+                if time.monotonic() >= next_report:
+                    next_report += args.interval
+                    traced = f"{tracemalloc.get_traced_memory()[0] / 1024 / 1024:7.1f}" if args.trace else '      -'
+                    print(
+                        f"{time.monotonic() - start:6.0f} {pushed:8d} {stub.pending_updates:7d} {rss_mb():8.1f} {traced} "
+                        f"{bot.outbound.pending:9d} {len(bot.group_settings):6d} {len(bot.spam_limiter):8d}"
+                    )
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await bot.post_stop(application)
+            await application.shutdown()
+            await bot.post_shutdown(application)
+            await stub.stop()
+
+    print(f"RSS {baseline:.1f} -> {rss_mb():.1f} MiB over {args.duration:.0f}s, {pushed} updates")
+    print(f"outbound {bot.outbound.snapshot()}")
+    print(f"stub {stub.snapshot()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=600, help="seconds to run")
+    parser.add_argument('--rate', type=int, default=200, help="chatter updates per second")
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--raid-every', type=float, default=30, help="seconds between raids")
+    parser.add_argument('--raid-size', type=int, default=100, help="users joining per raid")
+    parser.add_argument('--latency', type=float, default=0.05, help="stub latency per call, plus as much jitter")
+    parser.add_argument('--flood-probability', type=float, default=0.01, help="share of calls answered with 429")
+    parser.add_argument('--interval', type=float, default=10, help="seconds between reports")
+    parser.add_argument('--port', type=int, default=8182)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--trace', action='store_true', help="also report tracemalloc's traced memory (slower)")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    asyncio.run(soak(args))
+
+
+if __name__ == '__main__':
+    main()
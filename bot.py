@@ -1,11 +1,12 @@
 import os
 import logging
-import json
-import sqlite3
 import asyncio
+import hashlib
 import random
+import signal
+import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from telegram import (
     Update, User, Chat, ChatMember, ChatPermissions, 
     InlineKeyboardButton, InlineKeyboardMarkup
@@ -13,9 +14,23 @@ from telegram import (
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
     ContextTypes, CallbackQueryHandler, ChatMemberHandler,
-    ConversationHandler
+    ConversationHandler, TypeHandler
 )
-from telegram.constants import ParseMode
+from telegram.constants import ChatMemberStatus, ChatType, MessageLimit, ParseMode
+from telegram.error import BadRequest, TelegramError
+
+from captcha_image import ImageCaptchaPool
+from captcha_token import MAX_ENTERED_DIGITS, SUBMIT_KEY, CaptchaSigner
+from metrics import CACHE_REQUESTS, REGISTRY, InstrumentedRequest, instrument_handlers, register_cache
+from outbound import MODERATION, NOTICE, WELCOME, OutboundQueue
+from rate_limit import SlidingWindowLimiter
+from storage import ChatCache, Storage
+from update_processing import ChatOrderedUpdateProcessor
+from update_types import UpdateTypeStats, required_update_types
+from webhook_server import create_web_app, start_web_server
+from welcome_media import MediaLibrary, media_type_for_path
+from welcome_template import DEFAULT_WELCOME_TEXT, TemplateError, WelcomeTemplate
+from word_filter import BannedWordMatcher, normalize
 
 # Configure logging
 logging.basicConfig(
@@ -27,10 +42,91 @@ logger = logging.getLogger(__name__)
 # Conversation states
 WELCOME_TEXT, WELCOME_MEDIA, WELCOME_BUTTONS, RULES_TEXT = range(4)
 
+# Webhook mode is used when WEBHOOK_URL is set (e.g. https://hexalegends.onrender.com)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('PORT', '5000'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Bot API server, e.g. http://127.0.0.1:8081/bot for stub_bot_api.py (defaults to Telegram's)
+BOT_API_URL = os.getenv('BOT_API_URL')
+# Updates processed at the same time; updates of one chat always run in order
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))
+# When polling, serve /health and /metrics on this port (webhook mode serves them on PORT)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# getUpdates arguments for run_polling, passed again when polling restarts with
+# new allowed_updates
+POLLING_OPTIONS = {'poll_interval': 0.0, 'timeout': 10, 'bootstrap_retries': -1}
+
+# Chats whose settings and banned words are kept in memory; colder chats are
+# reloaded from SQLite when they are next active
+SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', '5000'))
+
+# Anti-spam: flood counters of users idle this long are dropped
+SPAM_IDLE_TTL = int(os.getenv('SPAM_IDLE_TTL', '300'))
+SPAM_EVICTION_INTERVAL = 60
+
+# Seconds a chat's administrator list is trusted before it is fetched again
+ADMIN_CACHE_TTL = int(os.getenv('ADMIN_CACHE_TTL', '300'))
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+# CAPTCHA: seconds to answer, and what happens to users who don't
+CAPTCHA_TIMEOUT = 300
+CAPTCHA_FAIL_ACTIONS = ('kick', 'ban', 'mute')
+CAPTCHA_MODES = ('math', 'image')
+# Signs CAPTCHA buttons; every instance must share it (defaults to one derived from the token)
+CAPTCHA_SECRET = os.getenv('CAPTCHA_SECRET')
+# Image CAPTCHAs kept rendered ahead of time, and worker processes rendering them
+CAPTCHA_POOL_SIZE = int(os.getenv('CAPTCHA_POOL_SIZE', '32'))
+CAPTCHA_POOL_WORKERS = int(os.getenv('CAPTCHA_POOL_WORKERS', '2'))
+
+# Seconds a queued welcome may wait for the chat's rate limit before it's dropped
+WELCOME_SEND_TTL = 120
+# A join seen through both the service message and a chat_member update within
+# this many seconds is greeted once
+JOIN_DEDUPE_SECONDS = 60
+# Old welcomes are deleted this many seconds after a new one, batched per chat
+WELCOME_DELETE_DELAY = 3
+# delete_messages accepts at most this many ids per call
+DELETE_MESSAGES_BATCH = 100
+# Welcome media rejected this many times in a row is skipped until replaced
+WELCOME_MEDIA_FAILURE_LIMIT = 3
+# Optional local image/GIF/video for chats without their own welcome media;
+# uploaded once, then sent by file_id
+WELCOME_MEDIA_PATH = os.getenv('WELCOME_MEDIA_PATH')
+DEFAULT_WELCOME_MEDIA = (
+    {'type': media_type_for_path(WELCOME_MEDIA_PATH), 'path': WELCOME_MEDIA_PATH} if WELCOME_MEDIA_PATH else None
+)
+
+MUTED_PERMISSIONS = ChatPermissions.no_permissions()
+
 class AdvancedWelcomeSecurityBot:
-    def __init__(self, token: str):
+    def __init__(self, token: str, db_path: str = 'bot_data.db', base_url: Optional[str] = None):
         self.token = token
-        self.application = Application.builder().token(token).build()
+        self.db_path = db_path
+        builder = (
+            Application.builder()
+            .token(token)
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+        )
+        if base_url:
+            # Another Bot API server, e.g. a local stub for benchmarks
+            builder = builder.base_url(base_url)
+        self.application = builder.build()
+        self.captcha_pool = ImageCaptchaPool(size=CAPTCHA_POOL_SIZE, workers=CAPTCHA_POOL_WORKERS)
+        secret = CAPTCHA_SECRET.encode() if CAPTCHA_SECRET else hashlib.sha256(f"captcha:{token}".encode()).digest()
+        self.captcha_signer = CaptchaSigner(secret)
+        # Automatic sends, deletes and restricts go through this, rate limited
+        self.outbound = OutboundQueue()
+        self._stop_event = None
+        self._loop = None
+        self._webhook = None  # (url, secret_token) while serving a webhook
+        self._metrics_runner = None
+        self.update_stats = UpdateTypeStats()
+        self.allowed_updates = None
         
         # Initialize database
         self.init_database()
@@ -40,207 +136,198 @@ class AdvancedWelcomeSecurityBot:
         
         # Setup handlers
         self.setup_handlers()
+        
+        # Setup periodic jobs
+        self.setup_jobs()
 
     def init_database(self):
-        """Initialize SQLite database for persistent storage"""
-        try:
-            self.conn = sqlite3.connect('bot_data.db', check_same_thread=False)
-            self.cursor = self.conn.cursor()
-            
-            # Create tables
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS group_settings (
-                    chat_id INTEGER PRIMARY KEY,
-                    welcome_enabled BOOLEAN DEFAULT 1,
-                    welcome_text TEXT,
-                    welcome_media TEXT,
-                    welcome_buttons TEXT,
-                    rules_text TEXT,
-                    max_warnings INTEGER DEFAULT 3,
-                    security_level INTEGER DEFAULT 1,
-                    antispam_enabled BOOLEAN DEFAULT 1,
-                    captcha_enabled BOOLEAN DEFAULT 0,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_warnings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    reason TEXT,
-                    admin_id INTEGER,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS banned_words (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
-                    word TEXT,
-                    action TEXT DEFAULT 'delete',
-                    created_by INTEGER,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            self.conn.commit()
+        """Initialize SQLite storage; queries run off the event loop"""
+        try:
+            self.storage = Storage(self.db_path)
             logger.info("Database initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing database: {e}")
 
     def load_data(self):
-        """Load data from database into memory"""
+        """Set up in-memory state; chat settings are loaded when first needed"""
         try:
-            self.group_settings = {}
             self.user_warnings = {}
             self.user_captchas = {}
-            self.banned_words = {}
-            self.user_message_count = {}
-            
-            # Load group settings
-            self.cursor.execute("SELECT * FROM group_settings")
-            for row in self.cursor.fetchall():
-                chat_id = row[0]
-                self.group_settings[chat_id] = {
-                    'welcome_enabled': bool(row[1]),
-                    'welcome_text': row[2],
-                    'welcome_media': json.loads(row[3]) if row[3] else None,
-                    'welcome_buttons': json.loads(row[4]) if row[4] else None,
-                    'rules_text': row[5],
-                    'max_warnings': row[6] or 3,
-                    'security_level': row[7] or 1,
-                    'antispam_enabled': bool(row[8]),
-                    'captcha_enabled': bool(row[9])
-                }
-            
-            # Load banned words
-            self.cursor.execute("SELECT chat_id, word, action FROM banned_words")
-            for row in self.cursor.fetchall():
-                chat_id = row[0]
-                if chat_id not in self.banned_words:
-                    self.banned_words[chat_id] = []
-                self.banned_words[chat_id].append({'word': row[1], 'action': row[2]})
+            self.spam_limiter = SlidingWindowLimiter(idle_ttl=SPAM_IDLE_TTL)
+            self.admin_cache = ChatCache(max_size=SETTINGS_CACHE_SIZE)  # chat_id -> (expires_at, set of admin user ids)
+            self.pending_welcomes = {}  # chat_id -> {'chat': Chat, 'users': [User]} waiting for the batch window
+            self.last_welcome_at = {}  # chat_id -> monotonic time of the last welcome sent
+            self.recent_joins = {}  # (chat_id, user_id) -> monotonic time the join was greeted
+            self.pending_welcome_deletes = {}  # chat_id -> message ids of replaced welcomes
+            self.welcome_cache = ChatCache(max_size=SETTINGS_CACHE_SIZE)  # chat_id -> (welcome_text, welcome_buttons, template, keyboard)
+            self.media_library = MediaLibrary(self.storage.media_cache, self.outbound)
+            
+            # Per-chat settings and banned words, loaded by load_chat_state before handlers run
+            self.group_settings = ChatCache(
+                self.storage.settings.load, SETTINGS_CACHE_SIZE, self.storage.settings.load_blocking
+            )
+            self.banned_words = ChatCache(
+                self.storage.banned_words.load, SETTINGS_CACHE_SIZE, self.storage.banned_words.load_blocking
+            )
+            self.word_matchers = ChatCache(
+                self.load_word_matcher, SETTINGS_CACHE_SIZE,
+                lambda chat_id: BannedWordMatcher(self.banned_words.get(chat_id, []))
+            )
+            # Read once at startup, before any update is handled
+            self.any_banned_words = self.storage.banned_words.any_words().result()
+            register_cache('settings', self.group_settings)
+            register_cache('banned_words', self.banned_words)
             
             logger.info("Data loaded successfully")
         except Exception as e:
             logger.error(f"Error loading data: {e}")
 
+    async def load_word_matcher(self, chat_id: int) -> BannedWordMatcher:
+        return BannedWordMatcher(await self.banned_words.load(chat_id, []))
+
+    async def load_chat_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Load the chat's settings and banned words before any handler reads them"""
+        chat = update.effective_chat
+        if chat is None:
+            return
+        try:
+            await self.group_settings.load(chat.id)
+            await self.word_matchers.load(chat.id)
+        except Exception as e:
+            logger.error(f"Error loading chat {chat.id}: {e}")
+
     def save_group_settings(self, chat_id: int):
-        """Save group settings to database"""
+        """Queue group settings for saving; does not wait for the disk"""
         try:
             settings = self.group_settings.get(chat_id, {})
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO group_settings 
-                (chat_id, welcome_enabled, welcome_text, welcome_media, welcome_buttons, rules_text, max_warnings, security_level, antispam_enabled, captcha_enabled)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                chat_id,
-                settings.get('welcome_enabled', True),
-                settings.get('welcome_text'),
-                json.dumps(settings.get('welcome_media')) if settings.get('welcome_media') else None,
-                json.dumps(settings.get('welcome_buttons')) if settings.get('welcome_buttons') else None,
-                settings.get('rules_text'),
-                settings.get('max_warnings', 3),
-                settings.get('security_level', 1),
-                settings.get('antispam_enabled', True),
-                settings.get('captcha_enabled', False)
-            ))
-            self.conn.commit()
+            self.storage.settings.save(chat_id, settings)
         except Exception as e:
             logger.error(f"Error saving group settings: {e}")
 
     def setup_handlers(self):
         """Setup all bot handlers"""
         try:
+            # Only new messages: edited messages and channel posts are never
+            # subscribed to unless a handler asks for them (see allowed_update_types)
+            def command(name, callback):
+                return CommandHandler(name, callback, filters=filters.UpdateType.MESSAGE)
+            
+            new_message = filters.UpdateType.MESSAGE
+            
             # Welcome conversation handler
             welcome_conv = ConversationHandler(
-                entry_points=[CommandHandler('setwelcome', self.setwelcome_command)],
+                entry_points=[command('setwelcome', self.setwelcome_command)],
                 states={
-                    WELCOME_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.set_welcome_text)],
-                    WELCOME_MEDIA: [MessageHandler(filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.TEXT, self.set_welcome_media)],
-                    WELCOME_BUTTONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.set_welcome_buttons)],
+                    WELCOME_TEXT: [MessageHandler(new_message & filters.TEXT & ~filters.COMMAND, self.set_welcome_text)],
+                    WELCOME_MEDIA: [MessageHandler(new_message & (filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.TEXT), self.set_welcome_media)],
+                    WELCOME_BUTTONS: [MessageHandler(new_message & filters.TEXT & ~filters.COMMAND, self.set_welcome_buttons)],
                 },
-                fallbacks=[CommandHandler('cancel', self.cancel_command)]
+                fallbacks=[command('cancel', self.cancel_command)]
             )
 
             rules_conv = ConversationHandler(
-                entry_points=[CommandHandler('setrules', self.setrules_command)],
+                entry_points=[command('setrules', self.setrules_command)],
                 states={
-                    RULES_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.set_rules_text)],
+                    RULES_TEXT: [MessageHandler(new_message & filters.TEXT & ~filters.COMMAND, self.set_rules_text)],
                 },
-                fallbacks=[CommandHandler('cancel', self.cancel_command)]
+                fallbacks=[command('cancel', self.cancel_command)]
             )
 
             # Add handlers
             handlers = [
                 welcome_conv,
                 rules_conv,
-                MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, self.welcome_handler),
-                CommandHandler("start", self.start_command),
-                CommandHandler("help", self.help_command),
-                CommandHandler("welcome", self.welcome_preview_command),
-                CommandHandler("rules", self.rules_command),
-                CommandHandler("settings", self.settings_command),
-                CommandHandler("security", self.security_command),
-                CommandHandler("warn", self.warn_command),
-                CommandHandler("ban", self.ban_command),
-                CommandHandler("mute", self.mute_command),
-                CommandHandler("unmute", self.unmute_command),
-                CommandHandler("kick", self.kick_command),
-                CommandHandler("unban", self.unban_command),
-                CommandHandler("warnings", self.warnings_command),
-                CommandHandler("clearwarns", self.clear_warnings_command),
-                CommandHandler("antispam", self.antispam_command),
-                CommandHandler("captcha", self.captcha_command),
-                CommandHandler("addword", self.add_banned_word_command),
-                CommandHandler("delword", self.del_banned_word_command),
-                CommandHandler("listwords", self.list_banned_words_command),
-                CommandHandler("report", self.report_command),
-                CommandHandler("info", self.info_command),
-                CommandHandler("stats", self.stats_command),
-                CommandHandler("members", self.members_command),
-                CommandHandler("testwelcome", self.testwelcome_command),
-                CommandHandler("testcaptcha", self.testcaptcha_command),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.message_handler),
-                MessageHandler(filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Document.ALL, self.media_handler),
+                MessageHandler(new_message & filters.StatusUpdate.NEW_CHAT_MEMBERS, self.welcome_handler),
+                ChatMemberHandler(self.chat_member_update_handler, ChatMemberHandler.CHAT_MEMBER),
+                command("start", self.start_command),
+                command("help", self.help_command),
+                command("welcome", self.welcome_preview_command),
+                command("rules", self.rules_command),
+                command("settings", self.settings_command),
+                command("security", self.security_command),
+                command("warn", self.warn_command),
+                command("ban", self.ban_command),
+                command("mute", self.mute_command),
+                command("unmute", self.unmute_command),
+                command("kick", self.kick_command),
+                command("unban", self.unban_command),
+                command("warnings", self.warnings_command),
+                command("clearwarns", self.clear_warnings_command),
+                command("antispam", self.antispam_command),
+                command("setflood", self.setflood_command),
+                command("welcomebatch", self.welcome_batch_command),
+                command("cleanwelcome", self.clean_welcome_command),
+                command("captcha", self.captcha_command),
+                command("captchaaction", self.captcha_action_command),
+                command("captchamode", self.captcha_mode_command),
+                command("addword", self.add_banned_word_command),
+                command("delword", self.del_banned_word_command),
+                command("listwords", self.list_banned_words_command),
+                command("report", self.report_command),
+                command("info", self.info_command),
+                command("stats", self.stats_command),
+                command("members", self.members_command),
+                command("testwelcome", self.testwelcome_command),
+                command("testcaptcha", self.testcaptcha_command),
+                MessageHandler(new_message & filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND, self.message_handler),
+                MessageHandler(
+                    new_message & filters.ChatType.GROUPS & (filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Document.ALL),
+                    self.media_handler
+                ),
+                # Only subscribed to while some group has banned words
+                MessageHandler(
+                    filters.UpdateType.EDITED_MESSAGE & filters.ChatType.GROUPS & (filters.TEXT | filters.CAPTION),
+                    self.edited_message_handler
+                ),
                 CallbackQueryHandler(self.button_handler, pattern="^welcome_"),
                 CallbackQueryHandler(self.button_handler, pattern="^security_"),
                 CallbackQueryHandler(self.button_handler, pattern="^captcha_"),
                 CallbackQueryHandler(self.button_handler, pattern="^moderation_"),
             ]
             
+            # Count every update first and load its chat, then count whatever
+            # no handler in group 0 took
+            self.application.add_handler(TypeHandler(Update, self.count_received_update), group=-2)
+            self.application.add_handler(TypeHandler(Update, self.load_chat_state), group=-1)
             for handler in handlers:
                 self.application.add_handler(handler)
+            self.application.add_handler(TypeHandler(Update, self.count_unhandled_update))
             
             self.application.add_error_handler(self.error_handler)
-            logger.info("All handlers setup successfully")
+            
+            # Call counts, errors and latency per handler on /metrics
+            instrumented = instrument_handlers(self.application)
+            logger.info(f"All handlers setup successfully ({instrumented} instrumented)")
         except Exception as e:
             logger.error(f"Error setting up handlers: {e}")
 
+    def setup_jobs(self):
+        """Schedule periodic maintenance jobs"""
+        try:
+            self.application.job_queue.run_repeating(
+                self.evict_spam_counters,
+                interval=SPAM_EVICTION_INTERVAL,
+                first=SPAM_EVICTION_INTERVAL,
+                name="evict_spam_counters"
+            )
+            self.application.job_queue.run_repeating(
+                self.evict_recent_joins,
+                interval=JOIN_DEDUPE_SECONDS,
+                first=JOIN_DEDUPE_SECONDS,
+                name="evict_recent_joins"
+            )
+            logger.info("Periodic jobs scheduled")
+        except Exception as e:
+            logger.error(f"Error scheduling jobs: {e}")
+
     # ===== WELCOME SYSTEM =====
     async def welcome_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle new chat members - ALWAYS send welcome"""
         try:
             if update.message and update.message.new_chat_members:
                 for user in update.message.new_chat_members:
-                    if user.is_bot:
-                        continue
-                        
-                    chat = update.effective_chat
-                    settings = self.group_settings.get(chat.id, {})
-                    
-                    if not settings.get('welcome_enabled', True):
-                        continue
-                    
-                    # ALWAYS send welcome message first
-                    await self.send_welcome_message(chat, user, context)
-                    
-                    # Then check if CAPTCHA is needed
-                    if settings.get('captcha_enabled'):
-                        await self.send_captcha(chat, user, context)
+                    if not user.is_bot:
+                        await self.greet_new_member(update.effective_chat, user, context)
                 
             elif update.chat_member:
                 chat = update.chat_member.chat
@@ -250,88 +337,299 @@ class AdvancedWelcomeSecurityBot:
                 if new_status in ['member', 'administrator'] and old_status in ['left', 'kicked']:
                     user = update.chat_member.new_chat_member.user
                     if not user.is_bot:
-                        settings = self.group_settings.get(chat.id, {})
-                        if settings.get('welcome_enabled', True):
-                            # ALWAYS send welcome message first
-                            await self.send_welcome_message(chat, user, context)
-                            
-                            # Then check if CAPTCHA is needed
-                            if settings.get('captcha_enabled'):
-                                await self.send_captcha(chat, user, context)
+                        await self.greet_new_member(chat, user, context)
         except Exception as e:
             logger.error(f"Error in welcome handler: {e}")
 
-    async def send_welcome_message(self, chat: Chat, user: User, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Send welcome message"""
+    async def greet_new_member(self, chat: Chat, user: User, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Welcome a new member and start their CAPTCHA, once per join"""
+        key = (chat.id, user.id)
+        now = time.monotonic()
+        if now - self.recent_joins.get(key, float('-inf')) < JOIN_DEDUPE_SECONDS:
+            return
+        self.recent_joins[key] = now
+        
+        settings = self.group_settings.get(chat.id, {})
+        if not settings.get('welcome_enabled', True):
+            return
+        
+        # ALWAYS send welcome message first
+        await self.queue_welcome(chat, user, context)
+        
+        # Then check if CAPTCHA is needed
+        if settings.get('captcha_enabled'):
+            await self.restrict_new_member(chat.id, user.id, context)
+            await self.send_captcha(chat, user, context)
+
+    async def queue_welcome(self, chat: Chat, user: User, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Greet at once in a quiet chat; merge joins within the batch window into one welcome"""
         try:
             settings = self.group_settings.get(chat.id, {})
-            welcome_text = settings.get('welcome_text') or "Welcome {name} to {group}! 🎉"
-            welcome_media = settings.get('welcome_media')
-            welcome_buttons = settings.get('welcome_buttons')
-            
-            formatted_text = welcome_text.format(
-                name=user.first_name,
-                username=f"@{user.username}" if user.username else user.first_name,
-                group=chat.title,
-                mention=user.mention_html(),
-                id=user.id
+            window = settings.get('welcome_batch_window', 10)
+            cap = settings.get('welcome_batch_max', 20)
+            
+            if window <= 0:
+                await self.send_welcome_message(chat, [user], context)
+                return
+            
+            batch = self.pending_welcomes.get(chat.id)
+            if batch is None:
+                since_last = time.monotonic() - self.last_welcome_at.get(chat.id, float('-inf'))
+                if since_last >= window:
+                    self.last_welcome_at[chat.id] = time.monotonic()
+                    await self.send_welcome_message(chat, [user], context)
+                    return
+                
+                batch = {'chat': chat, 'users': []}
+                self.pending_welcomes[chat.id] = batch
+                context.application.job_queue.run_once(
+                    self.flush_welcomes_callback,
+                    window - since_last,
+                    data={'chat_id': chat.id},
+                    name=f"flush_welcomes_{chat.id}"
+                )
+            
+            batch['users'].append(user)
+            if len(batch['users']) >= cap:
+                for job in context.application.job_queue.get_jobs_by_name(f"flush_welcomes_{chat.id}"):
+                    job.schedule_removal()
+                await self.flush_welcomes(chat.id, context)
+        except Exception as e:
+            logger.error(f"Error queueing welcome: {e}")
+
+    async def flush_welcomes_callback(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send the welcome for joins collected during the batch window"""
+        chat_id = context.job.data['chat_id']
+        await self.group_settings.load(chat_id)
+        await self.flush_welcomes(chat_id, context)
+
+    async def flush_welcomes(self, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send one welcome mentioning every pending member of a chat"""
+        batch = self.pending_welcomes.pop(chat_id, None)
+        if not batch or not batch['users']:
+            return
+        self.last_welcome_at[chat_id] = time.monotonic()
+        await self.send_welcome_message(batch['chat'], batch['users'], context)
+
+    async def evict_recent_joins(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Forget joins older than the dedupe window"""
+        try:
+            cutoff = time.monotonic() - JOIN_DEDUPE_SECONDS
+            expired = [key for key, seen in self.recent_joins.items() if seen <= cutoff]
+            for key in expired:
+                del self.recent_joins[key]
+        except Exception as e:
+            logger.error(f"Error evicting recent joins: {e}")
+
+    async def restrict_new_member(self, chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Mute a new member until the CAPTCHA is solved"""
+        try:
+            # Queued ahead of the welcome and CAPTCHA, and paced with them during raids
+            self.outbound.submit(MODERATION, context.bot.restrict_chat_member, chat_id, user_id, permissions=MUTED_PERMISSIONS)
+        except Exception as e:
+            logger.error(f"Error restricting new member: {e}")
+
+    async def lift_restriction(self, chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Give a verified member the group's default permissions back"""
+        try:
+            chat = await context.bot.get_chat(chat_id)
+            permissions = chat.permissions or ChatPermissions(
+                can_send_messages=True,
+                can_send_audios=True,
+                can_send_documents=True,
+                can_send_photos=True,
+                can_send_videos=True,
+                can_send_video_notes=True,
+                can_send_voice_notes=True,
+                can_send_polls=True,
+                can_send_other_messages=True,
+                can_add_web_page_previews=True,
+                can_invite_users=True
             )
+            self.outbound.submit(MODERATION, context.bot.restrict_chat_member, chat_id, user_id, permissions=permissions)
+        except Exception as e:
+            logger.error(f"Error lifting restriction: {e}")
+
+    async def send_welcome_message(self, chat: Chat, users: List[User], context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send one welcome message for one or more new members, more if it won't fit in one"""
+        try:
+            settings = self.group_settings.get(chat.id, {})
+            welcome_media = settings.get('welcome_media') or DEFAULT_WELCOME_MEDIA
+            template, reply_markup = self.welcome_plan(chat.id)
             
-            reply_markup = None
-            if welcome_buttons:
-                keyboard = []
-                for btn_row in welcome_buttons:
-                    row = []
-                    for btn in btn_row:
-                        row.append(InlineKeyboardButton(btn['text'], url=btn['url']))
-                    keyboard.append(row)
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            for part_users, formatted_text in self.split_welcome(template, chat, users):
+                self.submit_welcome(chat.id, welcome_media, formatted_text, reply_markup, context)
+                logger.info(f"Welcome message queued for {len(part_users)} user(s) in chat {chat.id}")
+        except Exception as e:
+            logger.error(f"Error sending welcome: {e}")
+
+    def split_welcome(self, template, chat: Chat, users: List[User]) -> List[Tuple[List[User], str]]:
+        """Rendered welcomes with the users split so that none is over Telegram's message length"""
+        parts = []
+        current, text = [], None
+        for user in users:
+            candidate = template.render(self.welcome_values(chat, current + [user]))
+            if current and len(candidate) > MessageLimit.MAX_TEXT_LENGTH:
+                parts.append((current, text))
+                current, text = [user], template.render(self.welcome_values(chat, [user]))
             else:
-                keyboard = [
-                    [InlineKeyboardButton("📜 Rules", callback_data="welcome_rules")],
-                    [InlineKeyboardButton("🔧 Help", callback_data="welcome_help")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                current, text = current + [user], candidate
+        if current:
+            parts.append((current, text))
+        return parts
+
+    def submit_welcome(self, chat_id: int, welcome_media: Optional[Dict], text: str, reply_markup,
+                       context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Queue one rendered welcome, with media if it fits in a caption"""
+        # Queued behind moderation; dropped if a raid keeps it waiting too long
+        if self.welcome_media_usable(chat_id, welcome_media, text):
+            sent = self.media_library.submit(
+                context.bot, chat_id, welcome_media, WELCOME,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML,
+                ttl=WELCOME_SEND_TTL
+            )
+            sent.add_done_callback(
+                lambda future: self.welcome_media_sent(chat_id, future, text, reply_markup, context)
+            )
+        else:
+            self.send_text_welcome(chat_id, text, reply_markup, context)
+
+    def send_text_welcome(self, chat_id: int, text: str, reply_markup, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Queue a welcome without media"""
+        sent = self.outbound.submit(
+            WELCOME, context.bot.send_message, chat_id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.HTML,
+            ttl=WELCOME_SEND_TTL
+        )
+        sent.add_done_callback(lambda future: self.welcome_sent(chat_id, future, context))
+
+    def welcome_media_usable(self, chat_id: int, welcome_media: Optional[Dict], text: str) -> bool:
+        """Whether to send media with this welcome, or text only"""
+        if not welcome_media:
+            return False
+        if len(text) > MessageLimit.CAPTION_LENGTH:
+            return False
+        if welcome_media.get('path') and not os.path.isfile(welcome_media['path']):
+            return False
+        # Media that keeps failing is skipped until an admin sets new media
+        return self.group_settings.get(chat_id, {}).get('welcome_media_failures', 0) < WELCOME_MEDIA_FAILURE_LIMIT
+
+    def welcome_media_sent(self, chat_id: int, future, text: str, reply_markup, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Count dead media and fall back to a text welcome when the media send is rejected"""
+        try:
+            settings = self.group_settings.setdefault(chat_id, {})
+            error = None if future.cancelled() else future.exception()
+            
+            if error is None:
+                if settings.get('welcome_media_failures'):
+                    settings['welcome_media_failures'] = 0
+                    self.save_group_settings(chat_id)
+                self.welcome_sent(chat_id, future, context)
+                return
             
-            if welcome_media:
-                media_type = welcome_media['type']
-                file_id = welcome_media['file_id']
-                
-                if media_type == 'photo':
-                    await context.bot.send_photo(
-                        chat_id=chat.id,
-                        photo=file_id,
-                        caption=formatted_text,
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.HTML
-                    )
-                elif media_type == 'video':
-                    await context.bot.send_video(
-                        chat_id=chat.id,
-                        video=file_id,
-                        caption=formatted_text,
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.HTML
+            if not isinstance(error, BadRequest):
+                return  # dropped or a network error: not the media's fault
+            
+            # e.g. "Wrong file identifier/http url specified"
+            if 'file' in str(error).lower():
+                failures = settings.get('welcome_media_failures', 0) + 1
+                settings['welcome_media_failures'] = failures
+                self.save_group_settings(chat_id)
+                if failures == WELCOME_MEDIA_FAILURE_LIMIT:
+                    logger.warning(f"Welcome media of chat {chat_id} failed {failures} times; sending text welcomes until it's replaced")
+            
+            self.send_text_welcome(chat_id, text, reply_markup, context)
+        except Exception as e:
+            logger.error(f"Error handling welcome media result: {e}")
+
+    def welcome_plan(self, chat_id: int):
+        """Compiled welcome template and keyboard of a chat, rebuilt only when its settings change"""
+        settings = self.group_settings.get(chat_id, {})
+        welcome_text = settings.get('welcome_text')
+        welcome_buttons = settings.get('welcome_buttons')
+        
+        cached = self.welcome_cache.get(chat_id)
+        if cached and cached[0] is welcome_text and cached[1] is welcome_buttons:
+            CACHE_REQUESTS.inc('welcome', 'hit')
+            return cached[2], cached[3]
+        CACHE_REQUESTS.inc('welcome', 'miss')
+        
+        template = WelcomeTemplate.lenient(welcome_text or DEFAULT_WELCOME_TEXT)
+        if welcome_buttons:
+            keyboard = []
+            for btn_row in welcome_buttons:
+                row = []
+                for btn in btn_row:
+                    row.append(InlineKeyboardButton(btn['text'], url=btn['url']))
+                keyboard.append(row)
+        else:
+            keyboard = [
+                [InlineKeyboardButton("📜 Rules", callback_data="welcome_rules")],
+                [InlineKeyboardButton("🔧 Help", callback_data="welcome_help")]
+            ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        self.welcome_cache[chat_id] = (welcome_text, welcome_buttons, template, reply_markup)
+        return template, reply_markup
+
+    @staticmethod
+    def welcome_values(chat: Chat, users: List[User]) -> Dict[str, str]:
+        """Placeholder values for a welcome greeting one or more users"""
+        return {
+            'name': ", ".join(user.first_name for user in users),
+            'username': ", ".join(f"@{user.username}" if user.username else user.first_name for user in users),
+            'group': chat.title or "",
+            'mention': ", ".join(user.mention_html() for user in users),
+            'id': ", ".join(str(user.id) for user in users),
+        }
+
+    def welcome_sent(self, chat_id: int, future, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Remember the newest welcome and, in keep-last mode, schedule the previous one for deletion"""
+        try:
+            if future.cancelled() or future.exception() is not None:
+                return
+            
+            settings = self.group_settings.setdefault(chat_id, {})
+            if not settings.get('welcome_keep_last'):
+                return
+            
+            previous = settings.get('last_welcome_message_id')
+            settings['last_welcome_message_id'] = future.result().message_id
+            self.save_group_settings(chat_id)
+            
+            if previous:
+                self.pending_welcome_deletes.setdefault(chat_id, []).append(previous)
+                if not context.application.job_queue.get_jobs_by_name(f"delete_welcomes_{chat_id}"):
+                    context.application.job_queue.run_once(
+                        self.delete_old_welcomes,
+                        WELCOME_DELETE_DELAY,
+                        data={'chat_id': chat_id},
+                        name=f"delete_welcomes_{chat_id}"
                     )
-                elif media_type == 'animation':
-                    await context.bot.send_animation(
-                        chat_id=chat.id,
-                        animation=file_id,
-                        caption=formatted_text,
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.HTML
+        except Exception as e:
+            logger.error(f"Error tracking welcome message: {e}")
+
+    async def delete_old_welcomes(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Delete replaced welcomes of a chat, many per call where the API allows it"""
+        try:
+            chat_id = context.job.data['chat_id']
+            message_ids = self.pending_welcome_deletes.pop(chat_id, [])
+            
+            # delete_messages needs Bot API 7.0 (python-telegram-bot 20.8+)
+            if hasattr(context.bot, 'delete_messages'):
+                for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH):
+                    self.outbound.submit(
+                        WELCOME, context.bot.delete_messages, chat_id, message_ids[i:i + DELETE_MESSAGES_BATCH]
                     )
             else:
-                await context.bot.send_message(
-                    chat_id=chat.id,
-                    text=formatted_text,
-                    reply_markup=reply_markup,
-                    parse_mode=ParseMode.HTML
-                )
-            
-            logger.info(f"Welcome message sent for user {user.id} in chat {chat.id}")
+                for message_id in message_ids:
+                    self.outbound.submit(WELCOME, context.bot.delete_message, chat_id, message_id)
         except Exception as e:
-            logger.error(f"Error sending welcome: {e}")
+            logger.error(f"Error deleting old welcomes: {e}")
 
     # ===== WELCOME CUSTOMIZATION =====
     async def setwelcome_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -364,6 +662,16 @@ class AdvancedWelcomeSecurityBot:
             chat_id = update.message.chat_id
             welcome_text = update.message.text
             
+            # Compile now so a broken template is caught here, not at join time
+            try:
+                WelcomeTemplate(welcome_text)
+            except TemplateError as e:
+                await update.message.reply_text(
+                    f"❌ {e}.\n\nAvailable: {{name}} {{username}} {{group}} {{mention}} {{id}}\n"
+                    "Please send the welcome text again, or /cancel."
+                )
+                return WELCOME_TEXT
+            
             if chat_id not in self.group_settings:
                 self.group_settings[chat_id] = {}
             
@@ -409,7 +717,12 @@ class AdvancedWelcomeSecurityBot:
                 await update.message.reply_text("❌ Please send a valid photo, video, or GIF.")
                 return WELCOME_MEDIA
             
+            if not await self.media_file_available(media_info['file_id'], context):
+                await update.message.reply_text("❌ Telegram can't find that file anymore. Please send it again.")
+                return WELCOME_MEDIA
+            
             self.group_settings[chat_id]['welcome_media'] = media_info
+            self.group_settings[chat_id]['welcome_media_failures'] = 0
             self.save_group_settings(chat_id)
             
             await update.message.reply_text(
@@ -426,6 +739,18 @@ class AdvancedWelcomeSecurityBot:
             await update.message.reply_text("❌ Error setting welcome media. Please try again.")
             return ConversationHandler.END
 
+    async def media_file_available(self, file_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Check a file_id with getFile before it's saved as welcome media"""
+        try:
+            await context.bot.get_file(file_id)
+            return True
+        except BadRequest as e:
+            # Files over 20 MB can be sent by file_id but not fetched
+            return 'too big' in str(e).lower()
+        except Exception as e:
+            logger.error(f"Error checking welcome media: {e}")
+            return True
+
     async def set_welcome_buttons(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Set welcome buttons"""
         try:
@@ -470,27 +795,14 @@ class AdvancedWelcomeSecurityBot:
                 return
             
             user = update.effective_user
-            welcome_text = settings.get('welcome_text', "Welcome {name} to {group}! 🎉")
-            formatted_text = welcome_text.format(
-                name=user.first_name,
-                username=f"@{user.username}" if user.username else user.first_name,
-                group=update.effective_chat.title,
-                mention=user.mention_html(),
-                id=user.id
-            )
+            template, reply_markup = self.welcome_plan(chat_id)
+            formatted_text = template.render(self.welcome_values(update.effective_chat, [user]))
+            
+            # The Rules/Help buttons only work inside the group
+            if not settings.get('welcome_buttons'):
+                reply_markup = None
             
             welcome_media = settings.get('welcome_media')
-            welcome_buttons = settings.get('welcome_buttons')
-            
-            reply_markup = None
-            if welcome_buttons:
-                keyboard = []
-                for btn_row in welcome_buttons:
-                    row = []
-                    for btn in btn_row:
-                        row.append(InlineKeyboardButton(btn['text'], url=btn['url']))
-                    keyboard.append(row)
-                reply_markup = InlineKeyboardMarkup(keyboard)
             
             if welcome_media:
                 media_type = welcome_media['type']
@@ -544,7 +856,7 @@ class AdvancedWelcomeSecurityBot:
             
             chat = update.effective_chat
             user = update.effective_user
-            await self.send_welcome_message(chat, user, context)
+            await self.send_welcome_message(chat, [user], context)
             await update.message.reply_text("✅ Test welcome message sent!")
         except Exception as e:
             logger.error(f"Error in testwelcome: {e}")
@@ -658,6 +970,105 @@ class AdvancedWelcomeSecurityBot:
             logger.error(f"Error toggling antispam: {e}")
             await update.message.reply_text("❌ Error toggling anti-spam.")
 
+    async def setflood_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Set anti-spam flood limit"""
+        try:
+            if not await self.is_admin(update, context):
+                await update.message.reply_text("❌ You need to be admin to use this command.", parse_mode=ParseMode.HTML)
+                return
+            
+            if len(context.args) != 2:
+                await update.message.reply_text("Usage: <code>/setflood messages seconds</code>", parse_mode=ParseMode.HTML)
+                return
+            
+            try:
+                max_messages = int(context.args[0])
+                window_seconds = int(context.args[1])
+            except ValueError:
+                await update.message.reply_text("❌ Messages and seconds must be numbers.")
+                return
+            
+            if not 1 <= max_messages <= 100 or not 1 <= window_seconds <= 3600:
+                await update.message.reply_text("❌ Messages must be 1-100 and seconds 1-3600.")
+                return
+            
+            chat_id = update.message.chat_id
+            if chat_id not in self.group_settings:
+                self.group_settings[chat_id] = {}
+            
+            self.group_settings[chat_id]['spam_max_messages'] = max_messages
+            self.group_settings[chat_id]['spam_window_seconds'] = window_seconds
+            self.save_group_settings(chat_id)
+            
+            await update.message.reply_text(f"✅ Flood limit set to {max_messages} messages per {window_seconds} seconds!")
+        except Exception as e:
+            logger.error(f"Error setting flood limit: {e}")
+            await update.message.reply_text("❌ Error setting flood limit.")
+
+    async def clean_welcome_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Toggle keeping only the latest welcome message"""
+        try:
+            if not await self.is_admin(update, context):
+                await update.message.reply_text("❌ You need to be admin to use this command.", parse_mode=ParseMode.HTML)
+                return
+            
+            chat_id = update.message.chat_id
+            if chat_id not in self.group_settings:
+                self.group_settings[chat_id] = {}
+            
+            current = self.group_settings[chat_id].get('welcome_keep_last', False)
+            self.group_settings[chat_id]['welcome_keep_last'] = not current
+            if current:
+                # Don't delete a welcome sent before the mode was last switched on
+                self.group_settings[chat_id]['last_welcome_message_id'] = None
+            self.save_group_settings(chat_id)
+            
+            status = "Only the latest welcome message will be kept" if not current else "Welcome messages will no longer be deleted"
+            await update.message.reply_text(f"✅ {status}!")
+        except Exception as e:
+            logger.error(f"Error toggling welcome cleanup: {e}")
+            await update.message.reply_text("❌ Error toggling welcome cleanup.")
+
+    async def welcome_batch_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Set how join waves are merged into one welcome"""
+        try:
+            if not await self.is_admin(update, context):
+                await update.message.reply_text("❌ You need to be admin to use this command.", parse_mode=ParseMode.HTML)
+                return
+            
+            if not 1 <= len(context.args) <= 2:
+                await update.message.reply_text(
+                    "Usage: <code>/welcomebatch seconds [max_members]</code>\n"
+                    "Joins within that many seconds share one welcome; 0 welcomes everyone separately.",
+                    parse_mode=ParseMode.HTML
+                )
+                return
+            
+            chat_id = update.message.chat_id
+            settings = self.group_settings.setdefault(chat_id, {})
+            try:
+                window = int(context.args[0])
+                cap = int(context.args[1]) if len(context.args) > 1 else settings.get('welcome_batch_max', 20)
+            except ValueError:
+                await update.message.reply_text("❌ Seconds and max members must be numbers.")
+                return
+            
+            if not 0 <= window <= 300 or not 1 <= cap <= 50:
+                await update.message.reply_text("❌ Seconds must be 0-300 and max members 1-50.")
+                return
+            
+            settings['welcome_batch_window'] = window
+            settings['welcome_batch_max'] = cap
+            self.save_group_settings(chat_id)
+            
+            if window:
+                await update.message.reply_text(f"✅ Joins within {window} seconds now share one welcome (up to {cap} members)!")
+            else:
+                await update.message.reply_text("✅ Every new member now gets their own welcome!")
+        except Exception as e:
+            logger.error(f"Error setting welcome batching: {e}")
+            await update.message.reply_text("❌ Error setting welcome batching.")
+
     async def captcha_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Toggle CAPTCHA"""
         try:
@@ -679,134 +1090,268 @@ class AdvancedWelcomeSecurityBot:
             logger.error(f"Error toggling CAPTCHA: {e}")
             await update.message.reply_text("❌ Error toggling CAPTCHA.")
 
+    async def captcha_action_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Set action for unsolved CAPTCHAs"""
+        try:
+            if not await self.is_admin(update, context):
+                await update.message.reply_text("❌ You need to be admin to use this command.", parse_mode=ParseMode.HTML)
+                return
+            
+            if not context.args or context.args[0].lower() not in CAPTCHA_FAIL_ACTIONS:
+                await update.message.reply_text("Usage: <code>/captchaaction kick|ban|mute</code>", parse_mode=ParseMode.HTML)
+                return
+            
+            chat_id = update.message.chat_id
+            if chat_id not in self.group_settings:
+                self.group_settings[chat_id] = {}
+            
+            action = context.args[0].lower()
+            self.group_settings[chat_id]['captcha_fail_action'] = action
+            self.save_group_settings(chat_id)
+            
+            await update.message.reply_text(f"✅ Users who don't solve the CAPTCHA will be: <code>{action}</code>", parse_mode=ParseMode.HTML)
+        except Exception as e:
+            logger.error(f"Error setting CAPTCHA action: {e}")
+            await update.message.reply_text("❌ Error setting CAPTCHA action.")
+
+    async def captcha_mode_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Switch between math and image CAPTCHA"""
+        try:
+            if not await self.is_admin(update, context):
+                await update.message.reply_text("❌ You need to be admin to use this command.", parse_mode=ParseMode.HTML)
+                return
+            
+            if not context.args or context.args[0].lower() not in CAPTCHA_MODES:
+                await update.message.reply_text("Usage: <code>/captchamode math|image</code>", parse_mode=ParseMode.HTML)
+                return
+            
+            chat_id = update.message.chat_id
+            if chat_id not in self.group_settings:
+                self.group_settings[chat_id] = {}
+            
+            mode = context.args[0].lower()
+            self.group_settings[chat_id]['captcha_mode'] = mode
+            self.save_group_settings(chat_id)
+            
+            if mode == 'image':
+                self.captcha_pool.start()
+            
+            await update.message.reply_text(f"✅ CAPTCHA mode set to: <code>{mode}</code>", parse_mode=ParseMode.HTML)
+        except Exception as e:
+            logger.error(f"Error setting CAPTCHA mode: {e}")
+            await update.message.reply_text("❌ Error setting CAPTCHA mode.")
+
     async def send_captcha(self, chat: Chat, user: User, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send CAPTCHA verification only"""
         try:
-            num1 = random.randint(1, 10)
-            num2 = random.randint(1, 10)
-            operation = random.choice(['+', '-', '*'])
-            
-            if operation == '+':
-                answer = num1 + num2
-            elif operation == '-':
-                answer = num1 - num2
+            image = None
+            if self.group_settings.get(chat.id, {}).get('captcha_mode') == 'image':
+                captcha_code, image = await self.captcha_pool.get()
+                captcha_text = (
+                    f"🔒 <b>CAPTCHA Verification for {user.mention_html()}</b>\n\n"
+                    f"Please enter the digits shown in the image.\n\n"
+                    f"⏰ You have 5 minutes to solve this!\n"
+                    f"⚠️ <i>You need to solve this to continue chatting!</i>"
+                )
+                challenge = f"image {captcha_code}"
             else:
-                answer = num1 * num2
-            
-            captcha_text = (
-                f"🔒 <b>CAPTCHA Verification for {user.mention_html()}</b>\n\n"
-                f"Please solve: <code>{num1} {operation} {num2} = ?</code>\n\n"
-                f"⏰ You have 5 minutes to solve this!\n"
-                f"⚠️ <i>You need to solve this to continue chatting!</i>"
-            )
-            captcha_code = str(answer)
+                num1 = random.randint(1, 10)
+                num2 = random.randint(1, 10)
+                operation = random.choice(['+', '-', '*'])
+                
+                # The keypad has no minus sign
+                if operation == '-' and num2 > num1:
+                    num1, num2 = num2, num1
+                
+                if operation == '+':
+                    answer = num1 + num2
+                elif operation == '-':
+                    answer = num1 - num2
+                else:
+                    answer = num1 * num2
+                
+                captcha_text = (
+                    f"🔒 <b>CAPTCHA Verification for {user.mention_html()}</b>\n\n"
+                    f"Please solve: <code>{num1} {operation} {num2} = ?</code>\n\n"
+                    f"⏰ You have 5 minutes to solve this!\n"
+                    f"⚠️ <i>You need to solve this to continue chatting!</i>"
+                )
+                captcha_code = str(answer)
+                challenge = f"{num1}{operation}{num2}={answer}"
             
+            # Verification needs nothing but the signed buttons; this entry only
+            # lets expiry know the CAPTCHA is still open
+            deadline = int(time.time()) + CAPTCHA_TIMEOUT
             key = f"{chat.id}_{user.id}"
             self.user_captchas[key] = {
-                'code': captcha_code,
-                'expires': datetime.now() + timedelta(minutes=5),
                 'user_id': user.id,
-                'chat_id': chat.id,
-                'current_answer': ''
+                'chat_id': chat.id
             }
             
-            keyboard = [
-                [InlineKeyboardButton("1", callback_data=f"captcha_{user.id}_1"),
-                InlineKeyboardButton("2", callback_data=f"captcha_{user.id}_2"),
-                InlineKeyboardButton("3", callback_data=f"captcha_{user.id}_3")],
-                [InlineKeyboardButton("4", callback_data=f"captcha_{user.id}_4"),
-                InlineKeyboardButton("5", callback_data=f"captcha_{user.id}_5"),
-                InlineKeyboardButton("6", callback_data=f"captcha_{user.id}_6")],
-                [InlineKeyboardButton("7", callback_data=f"captcha_{user.id}_7"),
-                InlineKeyboardButton("8", callback_data=f"captcha_{user.id}_8"),
-                InlineKeyboardButton("9", callback_data=f"captcha_{user.id}_9")],
-                [InlineKeyboardButton("0", callback_data=f"captcha_{user.id}_0"),
-                InlineKeyboardButton("Submit", callback_data=f"captcha_{user.id}_submit")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            tag = self.captcha_signer.answer_tag(chat.id, user.id, deadline, captcha_code)
+            reply_markup = self.captcha_keyboard(chat.id, user.id, deadline, tag)
             
-            captcha_msg = await context.bot.send_message(
-                chat_id=chat.id,
-                text=captcha_text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.HTML
-            )
+            if image:
+                sent = self.outbound.submit(
+                    NOTICE, context.bot.send_photo, chat.id,
+                    photo=image,
+                    caption=captcha_text,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.HTML
+                )
+            else:
+                sent = self.outbound.submit(
+                    NOTICE, context.bot.send_message, chat.id,
+                    text=captcha_text,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.HTML
+                )
             
-            self.user_captchas[key]['message_id'] = captcha_msg.message_id
-            logger.info(f"CAPTCHA sent for user {user.id}: {num1}{operation}{num2}={answer}")
+            # Don't hold up the join handler while the send waits its turn
+            captcha = self.user_captchas[key]
+            def remember_message(future):
+                if not future.cancelled() and future.exception() is None:
+                    captcha['message_id'] = future.result().message_id
+            sent.add_done_callback(remember_message)
+            
+            # Expire unanswered CAPTCHAs even if nobody presses a button
+            self.cancel_captcha_expiry(chat.id, user.id, context)
+            context.application.job_queue.run_once(
+                self.captcha_expired_callback,
+                CAPTCHA_TIMEOUT,
+                data={'chat_id': chat.id, 'user_id': user.id},
+                name=f"captcha_expire_{chat.id}_{user.id}"
+            )
+            logger.info(f"CAPTCHA queued for user {user.id}: {challenge}")
             
         except Exception as e:
             logger.error(f"Error sending CAPTCHA: {e}")
 
-    async def handle_captcha_answer(self, query, user_id, answer, context):
-        """Handle CAPTCHA answer"""
+    def captcha_keyboard(self, chat_id: int, user_id: int, deadline: int, tag: str, entered: str = '') -> InlineKeyboardMarkup:
+        """CAPTCHA keypad; each button carries the signed state it leads to"""
+        def button(key: str, label: str) -> InlineKeyboardButton:
+            return InlineKeyboardButton(
+                label,
+                callback_data=self.captcha_signer.encode(chat_id, user_id, deadline, entered, key, tag)
+            )
+        
+        keyboard = [
+            [button("1", "1"), button("2", "2"), button("3", "3")],
+            [button("4", "4"), button("5", "5"), button("6", "6")],
+            [button("7", "7"), button("8", "8"), button("9", "9")],
+            [button("0", "0"), button(SUBMIT_KEY, f"Submit: {entered}" if entered else "Submit")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
+    async def handle_captcha_answer(self, query, context):
+        """Handle CAPTCHA answer from signed callback data"""
         try:
             chat_id = query.message.chat.id
-            key = f"{chat_id}_{user_id}"
+            press = self.captcha_signer.decode(chat_id, query.data)
+            
+            if not press:
+                await query.answer("❌ Invalid CAPTCHA!", show_alert=True)
+                return
             
-            captcha_data = self.user_captchas.get(key)
+            user_id = press.user_id
+            key = f"{chat_id}_{user_id}"
             
-            if not captcha_data:
-                await query.answer("❌ CAPTCHA expired or not found!", show_alert=True)
+            # Other members can press the keypad too; only the new member's presses count
+            if query.from_user.id != user_id:
+                await query.answer("❌ This CAPTCHA isn't for you!", show_alert=True)
                 return
             
-            if datetime.now() > captcha_data['expires']:
+            if time.time() > press.deadline:
                 await query.answer("❌ CAPTCHA expired! Please wait for admin help.", show_alert=True)
-                del self.user_captchas[key]
+                self.user_captchas.pop(key, None)
                 return
             
-            if answer == "submit":
-                user_answer = captcha_data.get('current_answer', '')
-                if user_answer == captcha_data['code']:
+            if press.key == SUBMIT_KEY:
+                if self.captcha_signer.is_correct(chat_id, press):
                     # CAPTCHA solved successfully - DON'T send welcome again
-                    await query.edit_message_text(
-                        "✅ <b>CAPTCHA verified! You can now chat in the group! 🎉</b>", 
-                        parse_mode=ParseMode.HTML
-                    )
+                    verified_text = "✅ <b>CAPTCHA verified! You can now chat in the group! 🎉</b>"
+                    if query.message.photo:
+                        await query.edit_message_caption(caption=verified_text, parse_mode=ParseMode.HTML)
+                    else:
+                        await query.edit_message_text(verified_text, parse_mode=ParseMode.HTML)
+                    await query.answer()
+                    
+                    # Welcome was already sent when user joined, so no need to send again
+                    self.user_captchas.pop(key, None)
+                    self.cancel_captcha_expiry(chat_id, user_id, context)
+                    await self.lift_restriction(chat_id, user_id, context)
                     
                     # Delete CAPTCHA message after 5 seconds
-                    await context.application.job_queue.run_once(
-                        self.delete_message,
+                    context.application.job_queue.run_once(
+                        self.delete_message_callback,
                         5,
-                        data=chat_id,
+                        data={'chat_id': chat_id, 'message_id': query.message.message_id},
                         name=f"delete_{query.message.message_id}"
                     )
-                    
-                    # Welcome was already sent when user joined, so no need to send again
-                    del self.user_captchas[key]
                 else:
                     await query.answer("❌ Wrong answer! Try again.", show_alert=True)
                 return
             
-            # Handle number button presses (keep existing code)
-            captcha_data['current_answer'] += answer
+            # Number button: the next keypad carries the longer answer
+            if len(press.entered) >= MAX_ENTERED_DIGITS:
+                await query.answer(f"Entered: {press.entered}")
+                return
             
-            keyboard = [
-                [InlineKeyboardButton("1", callback_data=f"captcha_{user_id}_1"),
-                InlineKeyboardButton("2", callback_data=f"captcha_{user_id}_2"),
-                InlineKeyboardButton("3", callback_data=f"captcha_{user_id}_3")],
-                [InlineKeyboardButton("4", callback_data=f"captcha_{user_id}_4"),
-                InlineKeyboardButton("5", callback_data=f"captcha_{user_id}_5"),
-                InlineKeyboardButton("6", callback_data=f"captcha_{user_id}_6")],
-                [InlineKeyboardButton("7", callback_data=f"captcha_{user_id}_7"),
-                InlineKeyboardButton("8", callback_data=f"captcha_{user_id}_8"),
-                InlineKeyboardButton("9", callback_data=f"captcha_{user_id}_9")],
-                [InlineKeyboardButton("0", callback_data=f"captcha_{user_id}_0"),
-                InlineKeyboardButton(f"Submit: {captcha_data['current_answer']}", callback_data=f"captcha_{user_id}_submit")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            entered = press.entered + press.key
+            reply_markup = self.captcha_keyboard(chat_id, user_id, press.deadline, press.tag, entered)
             
-            original_text = query.message.text
-            await query.edit_message_text(
-                text=original_text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.HTML
-            )
+            if query.message.photo:
+                await query.edit_message_reply_markup(reply_markup=reply_markup)
+            else:
+                original_text = query.message.text_html
+                await query.edit_message_text(
+                    text=original_text,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.HTML
+                )
             
-            await query.answer(f"Entered: {captcha_data['current_answer']}")
+            await query.answer(f"Entered: {entered}")
         except Exception as e:
             logger.error(f"Error handling CAPTCHA answer: {e}")
 
+    def cancel_captcha_expiry(self, chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Remove a pending CAPTCHA expiry job"""
+        for job in context.application.job_queue.get_jobs_by_name(f"captcha_expire_{chat_id}_{user_id}"):
+            job.schedule_removal()
+
+    async def captcha_expired_callback(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Clean up an unsolved CAPTCHA and apply the group's fail action"""
+        try:
+            chat_id = context.job.data['chat_id']
+            user_id = context.job.data['user_id']
+            
+            captcha = self.user_captchas.pop(f"{chat_id}_{user_id}", None)
+            if captcha is None:
+                return
+            await self.group_settings.load(chat_id)
+            
+            if 'message_id' in captcha:
+                self.outbound.submit(MODERATION, context.bot.delete_message, chat_id, captcha['message_id'])
+            
+            # One call per chat in flight at a time, so the kick's unban follows its ban
+            action = self.group_settings.get(chat_id, {}).get('captcha_fail_action', 'kick')
+            if action == 'ban':
+                self.outbound.submit(MODERATION, context.bot.ban_chat_member, chat_id, user_id)
+            elif action == 'kick':
+                self.outbound.submit(MODERATION, context.bot.ban_chat_member, chat_id, user_id)
+                self.outbound.submit(MODERATION, context.bot.unban_chat_member, chat_id, user_id, only_if_banned=True)
+            elif action == 'mute':
+                # Already muted since joining; make sure it sticks
+                self.outbound.submit(
+                    MODERATION, context.bot.restrict_chat_member, chat_id,
+                    user_id=user_id,
+                    permissions=MUTED_PERMISSIONS
+                )
+            
+            logger.info(f"CAPTCHA expired for user {user_id} in chat {chat_id}: {action}")
+        except Exception as e:
+            logger.error(f"Error expiring CAPTCHA: {e}")
+
     # ===== MODERATION SYSTEM =====
     async def warn_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Warn a user"""
@@ -827,17 +1372,9 @@ class AdvancedWelcomeSecurityBot:
             reason = ' '.join(context.args[1:]) if len(context.args) > 1 else "No reason provided"
             chat_id = update.message.chat_id
             
-            self.cursor.execute(
-                "INSERT INTO user_warnings (user_id, chat_id, reason, admin_id) VALUES (?, ?, ?, ?)",
-                (target_user.id, chat_id, reason, update.effective_user.id)
+            warning_count = await self.storage.warnings.add(
+                chat_id, target_user.id, reason, update.effective_user.id
             )
-            self.conn.commit()
-            
-            self.cursor.execute(
-                "SELECT COUNT(*) FROM user_warnings WHERE user_id = ? AND chat_id = ?",
-                (target_user.id, chat_id)
-            )
-            warning_count = self.cursor.fetchone()[0]
             
             max_warnings = self.group_settings.get(chat_id, {}).get('max_warnings', 3)
             
@@ -1016,11 +1553,7 @@ class AdvancedWelcomeSecurityBot:
             
             chat_id = update.message.chat_id
             
-            self.cursor.execute(
-                "SELECT reason, timestamp FROM user_warnings WHERE user_id = ? AND chat_id = ? ORDER BY timestamp DESC",
-                (target_user.id, chat_id)
-            )
-            warnings = self.cursor.fetchall()
+            warnings = await self.storage.warnings.list(chat_id, target_user.id)
             
             if not warnings:
                 await update.message.reply_text(f"✅ User {target_user.mention_html()} has no warnings.", parse_mode=ParseMode.HTML)
@@ -1049,11 +1582,7 @@ class AdvancedWelcomeSecurityBot:
             
             chat_id = update.message.chat_id
             
-            self.cursor.execute(
-                "DELETE FROM user_warnings WHERE user_id = ? AND chat_id = ?",
-                (target_user.id, chat_id)
-            )
-            self.conn.commit()
+            await self.storage.warnings.clear(chat_id, target_user.id)
             
             await update.message.reply_text(f"✅ Warnings cleared for {target_user.mention_html()}.", parse_mode=ParseMode.HTML)
         except Exception as e:
@@ -1081,15 +1610,17 @@ class AdvancedWelcomeSecurityBot:
             
             chat_id = update.message.chat_id
             
-            self.cursor.execute(
-                "INSERT INTO banned_words (chat_id, word, action, created_by) VALUES (?, ?, ?, ?)",
-                (chat_id, word, action, update.effective_user.id)
-            )
-            self.conn.commit()
+            await self.storage.banned_words.add(chat_id, word, action, update.effective_user.id)
             
-            if chat_id not in self.banned_words:
-                self.banned_words[chat_id] = []
-            self.banned_words[chat_id].append({'word': word, 'action': action})
+            # Chats that aren't held pick the word up when they are next loaded
+            words = self.banned_words.cached(chat_id)
+            if words is not None:
+                words.append({'word': word, 'action': action})
+            matcher = self.word_matchers.cached(chat_id)
+            if matcher is not None:
+                matcher.add(word, action)
+            self.any_banned_words = True
+            self.schedule_allowed_updates_refresh(context)
             
             await update.message.reply_text(f"✅ Banned word added: '<code>{word}</code>' with action: <code>{action}</code>", parse_mode=ParseMode.HTML)
         except Exception as e:
@@ -1110,14 +1641,22 @@ class AdvancedWelcomeSecurityBot:
             word = context.args[0].lower()
             chat_id = update.message.chat_id
             
-            self.cursor.execute(
-                "DELETE FROM banned_words WHERE chat_id = ? AND word = ?",
-                (chat_id, word)
-            )
-            self.conn.commit()
-            
-            if chat_id in self.banned_words:
-                self.banned_words[chat_id] = [w for w in self.banned_words[chat_id] if w['word'] != word]
+            await self.storage.banned_words.remove(chat_id, word)
+            
+            words = self.banned_words.cached(chat_id)
+            if words is not None:
+                words[:] = [w for w in words if w['word'] != word]
+            matcher = self.word_matchers.cached(chat_id)
+            if matcher is not None and words is not None:
+                matcher.remove(word)
+                # Other words normalizing alike keep the entry alive
+                for entry in words:
+                    if normalize(entry['word']) == normalize(word):
+                        matcher.add(entry['word'], entry['action'])
+            elif matcher is not None:
+                self.word_matchers.discard(chat_id)
+            self.any_banned_words = await asyncio.wrap_future(self.storage.banned_words.any_words())
+            self.schedule_allowed_updates_refresh(context)
             
             await update.message.reply_text(f"✅ Banned word removed: '<code>{word}</code>'", parse_mode=ParseMode.HTML)
         except Exception as e:
@@ -1158,7 +1697,7 @@ class AdvancedWelcomeSecurityBot:
             if self.group_settings.get(chat_id, {}).get('antispam_enabled', True):
                 await self.anti_spam_check(update, context)
             
-            await self.banned_words_check(update, context, text.lower())
+            await self.banned_words_check(update, context, text)
         except Exception as e:
             logger.error(f"Error in message handler: {e}")
 
@@ -1175,91 +1714,130 @@ class AdvancedWelcomeSecurityBot:
         except Exception as e:
             logger.error(f"Error in media handler: {e}")
 
+    async def edited_message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Check edited messages for banned words, so they can't be edited in afterwards"""
+        try:
+            message = update.edited_message
+            if not message:
+                return
+            
+            text = message.text or message.caption or ""
+            await self.banned_words_check(update, context, text)
+        except Exception as e:
+            logger.error(f"Error in edited message handler: {e}")
+
+    async def count_received_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Count every incoming update by type"""
+        self.update_stats.record_received(update)
+
+    async def count_unhandled_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Count updates that no handler took: candidates for dropping from allowed_updates"""
+        self.update_stats.record_unhandled(update)
+
     async def anti_spam_check(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Check for spam - FIXED VERSION"""
         try:
             user_id = update.effective_user.id
             chat_id = update.effective_chat.id
+            settings = self.group_settings.get(chat_id, {})
             
-            if user_id not in self.user_message_count:
-                self.user_message_count[user_id] = {'count': 0, 'last_time': datetime.now()}
-            
-            user_data = self.user_message_count[user_id]
-            current_time = datetime.now()
-            
-            if (current_time - user_data['last_time']).seconds > 10:
-                user_data['count'] = 0
-            
-            user_data['count'] += 1
-            user_data['last_time'] = current_time
+            flooding = self.spam_limiter.hit(
+                (chat_id, user_id),
+                settings.get('spam_max_messages', 5),
+                settings.get('spam_window_seconds', 10)
+            )
             
-            if user_data['count'] > 5:
-                await context.bot.delete_message(chat_id, update.message.message_id)
-                warning_msg = await context.bot.send_message(
+            if flooding:
+                self.outbound.submit(MODERATION, context.bot.delete_message, chat_id, update.message.message_id)
+                # One warning per flooding user while it's still queued
+                self.send_temporary_message(
                     chat_id,
                     f"⚠️ {update.effective_user.mention_html()} - Please don't spam!",
-                    parse_mode=ParseMode.HTML
-                )
-                
-                # FIXED: Use run_once correctly without await
-                context.application.job_queue.run_once(
-                    self.delete_message_callback,
-                    5,
-                    data={'chat_id': chat_id, 'message_id': warning_msg.message_id},
-                    name=f"delete_{warning_msg.message_id}"
+                    context,
+                    coalesce_key=('spam_warning', chat_id, user_id)
                 )
         except Exception as e:
             logger.error(f"Error in anti-spam: {e}")
     
+    async def evict_spam_counters(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Drop flood counters of idle users"""
+        try:
+            evicted = self.spam_limiter.evict_idle()
+            if evicted:
+                logger.info(f"Evicted {evicted} idle flood counters, {len(self.spam_limiter)} active")
+        except Exception as e:
+            logger.error(f"Error evicting flood counters: {e}")
+
     async def delete_message_callback(self, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Callback to delete message - FIXED VERSION"""
         try:
             chat_id = context.job.data['chat_id']
             message_id = context.job.data['message_id']
-            await context.bot.delete_message(chat_id, message_id)
+            self.outbound.submit(MODERATION, context.bot.delete_message, chat_id, message_id)
         except Exception as e:
             logger.error(f"Error deleting message: {e}")
 
+    def send_temporary_message(self, chat_id: int, text: str, context: ContextTypes.DEFAULT_TYPE, delete_after: int = 5, **submit_kwargs) -> None:
+        """Queue a notice and delete it delete_after seconds after it's sent"""
+        def schedule_delete(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            message_id = future.result().message_id
+            context.application.job_queue.run_once(
+                self.delete_message_callback,
+                delete_after,
+                data={'chat_id': chat_id, 'message_id': message_id},
+                name=f"delete_{message_id}"
+            )
+        
+        sent = self.outbound.submit(NOTICE, context.bot.send_message, chat_id, text, parse_mode=ParseMode.HTML, **submit_kwargs)
+        sent.add_done_callback(schedule_delete)
+
     async def banned_words_check(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
-        """Check for banned words"""
+        """Check for banned words; the matcher normalizes text against obfuscation"""
         try:
             chat_id = update.effective_chat.id
-            words = self.banned_words.get(chat_id, [])
+            matcher = self.word_matchers.get(chat_id)
+            if not matcher:
+                return
             
-            for banned_word in words:
-                if banned_word['word'] in text:
-                    action = banned_word['action']
-                    
-                    await context.bot.delete_message(chat_id, update.message.message_id)
-                    
-                    if action == "warn":
-                        self.cursor.execute(
-                            "INSERT INTO user_warnings (user_id, chat_id, reason, admin_id) VALUES (?, ?, ?, ?)",
-                            (update.effective_user.id, chat_id, f"Used banned word: {banned_word['word']}", context.bot.id)
-                        )
-                        self.conn.commit()
-                        
-                        await context.bot.send_message(
-                            chat_id,
-                            f"⚠️ {update.effective_user.mention_html()} - Warning for using banned word!",
-                            parse_mode=ParseMode.HTML
-                        )
-                        
-                    elif action == "mute":
-                        permissions = ChatPermissions(can_send_messages=False)
-                        await context.bot.restrict_chat_member(
-                            chat_id=chat_id,
-                            user_id=update.effective_user.id,
-                            permissions=permissions,
-                            until_date=datetime.now() + timedelta(hours=1)
-                        )
-                        
-                        await context.bot.send_message(
-                            chat_id,
-                            f"🔇 {update.effective_user.mention_html()} - Muted for 1 hour for using banned word!",
-                            parse_mode=ParseMode.HTML
-                        )
-                    break
+            hit = matcher.match(text)
+            if not hit:
+                return
+            
+            word, action = hit
+            self.outbound.submit(MODERATION, context.bot.delete_message, chat_id, update.effective_message.message_id)
+            
+            if action == "warn":
+                user_id = update.effective_user.id
+                warning_count = await self.storage.warnings.add(
+                    chat_id, user_id, f"Used banned word: {word}", context.bot.id
+                )
+                max_warnings = self.group_settings.get(chat_id, {}).get('max_warnings', 3)
+                
+                if warning_count >= max_warnings:
+                    await self.ban_user_automatically(chat_id, user_id, context, "Maximum warnings reached")
+                else:
+                    self.outbound.submit(
+                        NOTICE, context.bot.send_message, chat_id,
+                        f"⚠️ {update.effective_user.mention_html()} - Warning {warning_count}/{max_warnings} for using banned word!",
+                        parse_mode=ParseMode.HTML
+                    )
+                
+            elif action == "mute":
+                permissions = ChatPermissions(can_send_messages=False)
+                self.outbound.submit(
+                    MODERATION, context.bot.restrict_chat_member, chat_id,
+                    user_id=update.effective_user.id,
+                    permissions=permissions,
+                    until_date=datetime.now() + timedelta(hours=1)
+                )
+                
+                self.outbound.submit(
+                    NOTICE, context.bot.send_message, chat_id,
+                    f"🔇 {update.effective_user.mention_html()} - Muted for 1 hour for using banned word!",
+                    parse_mode=ParseMode.HTML
+                )
         except Exception as e:
             logger.error(f"Error handling banned word: {e}")
 
@@ -1274,12 +1852,58 @@ class AdvancedWelcomeSecurityBot:
             if user.id in [6468620868]:
                 return True
             
-            chat_member = await context.bot.get_chat_member(chat.id, user.id)
-            return chat_member.status in ['administrator', 'creator']
+            if chat.type == ChatType.PRIVATE:
+                return False
+            
+            admins = await self.get_chat_admins(chat.id, context)
+            return user.id in admins
         except Exception as e:
             logger.error(f"Error checking admin status: {e}")
             return False
 
+    async def get_chat_admins(self, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> set:
+        """Get admin user ids of a chat, cached for ADMIN_CACHE_TTL seconds"""
+        cached = self.admin_cache.get(chat_id)
+        if cached and cached[0] > time.monotonic():
+            CACHE_REQUESTS.inc('admins', 'hit')
+            return cached[1]
+        CACHE_REQUESTS.inc('admins', 'miss')
+        
+        administrators = await context.bot.get_chat_administrators(chat_id)
+        admins = {member.user.id for member in administrators}
+        self.admin_cache[chat_id] = (time.monotonic() + ADMIN_CACHE_TTL, admins)
+        return admins
+
+    async def chat_member_update_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Greet joins and keep the admin cache in sync with promotions and demotions"""
+        try:
+            member_update = update.chat_member
+            chat_id = member_update.chat.id
+            old_status = member_update.old_chat_member.status
+            new_status = member_update.new_chat_member.status
+            
+            # Joins without a service message (e.g. hidden join messages) are
+            # only seen here; greet_new_member drops the duplicate otherwise
+            await self.welcome_handler(update, context)
+            
+            was_admin = old_status in ADMIN_STATUSES
+            is_admin = new_status in ADMIN_STATUSES
+            if was_admin == is_admin:
+                return
+            
+            cached = self.admin_cache.get(chat_id)
+            if not cached:
+                return
+            
+            user_id = member_update.new_chat_member.user.id
+            if is_admin:
+                cached[1].add(user_id)
+            else:
+                cached[1].discard(user_id)
+            logger.info(f"Admin cache updated for chat {chat_id}: user {user_id} is now {new_status}")
+        except Exception as e:
+            logger.error(f"Error handling chat member update: {e}")
+
     async def extract_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[User]:
         """Extract user from command"""
         try:
@@ -1307,23 +1931,21 @@ class AdvancedWelcomeSecurityBot:
         """Handle inline keyboard button presses"""
         try:
             query = update.callback_query
-            await query.answer()
-            
             data = query.data
             
+            # CAPTCHA presses answer the query themselves, with feedback
+            if data.startswith("captcha_"):
+                await self.handle_captcha_answer(query, context)
+                return
+            
+            await query.answer()
+            
             if data.startswith("welcome_"):
                 if data == "welcome_rules":
                     await self.rules_command(update, context)
                 elif data == "welcome_help":
                     await self.help_command(update, context)
             
-            elif data.startswith("captcha_"):
-                parts = data.split('_')
-                if len(parts) >= 3:
-                    user_id = int(parts[1])
-                    answer = parts[2]
-                    await self.handle_captcha_answer(query, user_id, answer, context)
-            
             elif data.startswith("security_"):
                 if data == "security_antispam":
                     await self.antispam_command(update, context)
@@ -1334,27 +1956,15 @@ class AdvancedWelcomeSecurityBot:
         except Exception as e:
             logger.error(f"Error in button handler: {e}")
 
-# REMOVE THIS OLD METHOD:
-    async def delete_message(self, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Delete a message"""
-        try:
-            await context.bot.delete_message(context.job.data, context.job.name.replace('delete_', ''))
-        except Exception as e:
-            logger.error(f"Error deleting message: {e}")
-
     async def ban_user_automatically(self, chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE, reason: str) -> None:
         """Auto-ban user"""
         try:
-            await context.bot.ban_chat_member(chat_id, user_id)
+            self.outbound.submit(MODERATION, context.bot.ban_chat_member, chat_id, user_id)
             
-            self.cursor.execute(
-                "DELETE FROM user_warnings WHERE user_id = ? AND chat_id = ?",
-                (user_id, chat_id)
-            )
-            self.conn.commit()
+            await self.storage.warnings.clear(chat_id, user_id)
             
-            await context.bot.send_message(
-                chat_id,
+            self.outbound.submit(
+                NOTICE, context.bot.send_message, chat_id,
                 f"🔨 <b>User auto-banned for:</b> {reason}",
                 parse_mode=ParseMode.HTML
             )
@@ -1396,11 +2006,16 @@ class AdvancedWelcomeSecurityBot:
                 "/welcome - Preview welcome message\n\n"
                 "🎨 <b>Welcome System (Admins):</b>\n"
                 "/setwelcome - Setup welcome message\n"
+                "/welcomebatch - Merge join waves into one welcome\n"
+                "/cleanwelcome - Keep only the latest welcome\n"
                 "/setrules - Set group rules\n\n"
                 "🛡️ <b>Security (Admins):</b>\n"
                 "/security - Security settings\n"
                 "/antispam - Toggle anti-spam\n"
+                "/setflood - Set flood limit\n"
                 "/captcha - Toggle CAPTCHA\n"
+                "/captchamode - Math or image CAPTCHA\n"
+                "/captchaaction - Kick, ban or mute unverified users\n"
                 "/addword - Add banned word\n"
                 "/delword - Remove banned word\n"
                 "/listwords - List banned words\n\n"
@@ -1434,9 +2049,15 @@ class AdvancedWelcomeSecurityBot:
             settings_text = (
                 "⚙️ <b>Bot Settings</b>\n\n"
                 f"Welcome Enabled: {'✅' if settings.get('welcome_enabled', True) else '❌'}\n"
+                f"Welcome Batching: {settings.get('welcome_batch_window', 10)}s / {settings.get('welcome_batch_max', 20)} members\n"
+                f"Keep Only Last Welcome: {'✅' if settings.get('welcome_keep_last', False) else '❌'}\n"
+                f"Welcome Media: {self.welcome_media_status(settings)}\n"
                 f"Anti-Spam: {'✅' if settings.get('antispam_enabled', True) else '❌'}\n"
                 f"CAPTCHA: {'✅' if settings.get('captcha_enabled', False) else '❌'}\n"
+                f"CAPTCHA Mode: {settings.get('captcha_mode', 'math')}\n"
+                f"CAPTCHA Fail Action: {settings.get('captcha_fail_action', 'kick')}\n"
                 f"Max Warnings: {settings.get('max_warnings', 3)}\n"
+                f"Flood Limit: {settings.get('spam_max_messages', 5)} msgs / {settings.get('spam_window_seconds', 10)}s\n"
                 f"Security Level: {settings.get('security_level', 1)}\n\n"
                 f"Banned Words: {len(self.banned_words.get(chat_id, []))}\n"
             )
@@ -1445,6 +2066,19 @@ class AdvancedWelcomeSecurityBot:
         except Exception as e:
             logger.error(f"Error in settings command: {e}")
 
+    @staticmethod
+    def welcome_media_status(settings: Dict) -> str:
+        """Welcome media type, flagged when Telegram keeps rejecting it"""
+        media = settings.get('welcome_media')
+        if not media:
+            return "none"
+        failures = settings.get('welcome_media_failures', 0)
+        if failures >= WELCOME_MEDIA_FAILURE_LIMIT:
+            return f"⚠️ {media['type']} unavailable, set it again with /setwelcome"
+        if failures:
+            return f"{media['type']} ({failures} failed sends)"
+        return media['type']
+
     async def security_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Security settings"""
         try:
@@ -1459,9 +2093,11 @@ class AdvancedWelcomeSecurityBot:
                 "🛡️ <b>Security Settings</b>\n\n"
                 f"Anti-Spam: {'✅ ON' if settings.get('antispam_enabled', True) else '❌ OFF'}\n"
                 f"CAPTCHA: {'✅ ON' if settings.get('captcha_enabled', False) else '❌ OFF'}\n"
+                f"Flood Limit: {settings.get('spam_max_messages', 5)} msgs / {settings.get('spam_window_seconds', 10)}s\n"
                 f"Max Warnings: {settings.get('max_warnings', 3)}\n\n"
                 "<b>Commands:</b>\n"
                 "/antispam - Toggle anti-spam\n"
+                "/setflood - Set flood limit\n"
                 "/captcha - Toggle CAPTCHA\n"
                 "/addword - Add banned word\n"
                 "/listwords - Show banned words"
@@ -1522,11 +2158,7 @@ class AdvancedWelcomeSecurityBot:
         try:
             chat_id = update.message.chat_id
             
-            self.cursor.execute("SELECT COUNT(*) FROM user_warnings WHERE chat_id = ?", (chat_id,))
-            total_warnings = self.cursor.fetchone()[0]
-            
-            self.cursor.execute("SELECT COUNT(DISTINCT user_id) FROM user_warnings WHERE chat_id = ?", (chat_id,))
-            warned_users = self.cursor.fetchone()[0]
+            total_warnings, warned_users = await self.storage.warnings.chat_stats(chat_id)
             
             stats_text = (
                 f"📊 <b>Group Statistics</b>\n\n"
@@ -1573,11 +2205,69 @@ class AdvancedWelcomeSecurityBot:
         except Exception as e:
             logger.error(f"Error in error handler: {e}")
 
+    # ===== UPDATE SUBSCRIPTION =====
+    def allowed_update_types(self) -> List[str]:
+        """Update types the registered handlers need, given current group settings"""
+        handlers = [handler for group in self.application.handlers.values() for handler in group]
+        needed = required_update_types(handlers)
+        
+        # Edited messages are only checked for banned words
+        if not self.any_banned_words:
+            needed = [t for t in needed if t != Update.EDITED_MESSAGE]
+        return needed
+
+    def schedule_allowed_updates_refresh(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Re-subscribe soon if a settings change altered the needed update types"""
+        if self.allowed_updates is None or self.allowed_update_types() == self.allowed_updates:
+            return
+        if not context.job_queue.get_jobs_by_name("refresh_allowed_updates"):
+            context.job_queue.run_once(self.refresh_allowed_updates, 1, name="refresh_allowed_updates")
+
+    async def refresh_allowed_updates(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Apply a changed allowed_updates to the webhook or the running poller"""
+        try:
+            allowed = self.allowed_update_types()
+            if allowed == self.allowed_updates:
+                return
+            
+            if self._webhook:
+                url, secret_token = self._webhook
+                await context.bot.set_webhook(
+                    url=url,
+                    allowed_updates=allowed,
+                    secret_token=secret_token,
+                    max_connections=max(UPDATE_CONCURRENCY, 40)
+                )
+            else:
+                # getUpdates takes allowed_updates on every call, so restart polling with the new list
+                updater = context.application.updater
+                if not updater or not updater.running:
+                    return
+                # drop_pending_updates is left out: it would drop whatever
+                # arrived while polling was stopped
+                await updater.stop()
+                await updater.start_polling(
+                    allowed_updates=allowed,
+                    error_callback=self.polling_error,
+                    **POLLING_OPTIONS
+                )
+            
+            self.allowed_updates = allowed
+            logger.info(f"Now receiving update types: {', '.join(allowed)}")
+        except Exception as e:
+            logger.error(f"Error refreshing allowed updates: {e}")
+
+    def polling_error(self, error: TelegramError) -> None:
+        """Hand getUpdates errors to the error handler, as run_polling does"""
+        self.application.create_task(self.application.process_error(error=error, update=None))
+
     async def run_async(self):
         """Run the bot asynchronously"""
         try:
             logger.info("Starting Advanced Welcome Security Bot...")
-            await self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+            self.allowed_updates = self.allowed_update_types()
+            logger.info(f"Receiving update types: {', '.join(self.allowed_updates)}")
+            await self.application.run_polling(allowed_updates=self.allowed_updates, **POLLING_OPTIONS)
         except Exception as e:
             logger.error(f"Error running bot: {e}")
     
@@ -1585,16 +2275,121 @@ class AdvancedWelcomeSecurityBot:
         """Start the bot"""
         try:
             logger.info("Starting Advanced Welcome Security Bot...")
-            self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+            self.allowed_updates = self.allowed_update_types()
+            logger.info(f"Receiving update types: {', '.join(self.allowed_updates)}")
+            self.application.run_polling(allowed_updates=self.allowed_updates, **POLLING_OPTIONS)
+        except Exception as e:
+            logger.error(f"Error running bot: {e}")
+    
+    async def run_webhook_async(self, webhook_url: str, port: int = WEBHOOK_PORT) -> None:
+        """Serve Telegram updates through a webhook, plus /health and /metrics, in this process"""
+        application = self.application
+        secret_token = WEBHOOK_SECRET or hashlib.sha256(f"webhook:{self.token}".encode()).hexdigest()
+        
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self._stop_event.set)
+            except NotImplementedError:
+                pass
+        
+        runner = None
+        try:
+            await application.initialize()
+            await self.post_init(application)
+            self.allowed_updates = self.allowed_update_types()
+            self._webhook = (f"{webhook_url.rstrip('/')}/{WEBHOOK_PATH}", secret_token)
+            await application.bot.set_webhook(
+                url=self._webhook[0],
+                allowed_updates=self.allowed_updates,
+                secret_token=secret_token,
+                max_connections=max(UPDATE_CONCURRENCY, 40)
+            )
+            logger.info(f"Receiving update types: {', '.join(self.allowed_updates)}")
+            await application.start()
+            
+            web_app = create_web_app(
+                application, WEBHOOK_PATH, secret_token, self.update_stats, self.outbound, REGISTRY
+            )
+            runner = await start_web_server(web_app, port)
+            logger.info(f"Webhook set to {webhook_url}, processing {UPDATE_CONCURRENCY} updates at a time")
+            
+            await self._stop_event.wait()
+        finally:
+            if runner:
+                await runner.cleanup()
+            if application.running:
+                await application.stop()
+                await self.post_stop(application)
+            await application.shutdown()
+            await self.post_shutdown(application)
+    
+    def run_webhook(self, webhook_url: str = None, port: int = WEBHOOK_PORT):
+        """Start the bot in webhook mode"""
+        try:
+            logger.info("Starting Advanced Welcome Security Bot (webhook)...")
+            asyncio.run(self.run_webhook_async(webhook_url or WEBHOOK_URL, port))
         except Exception as e:
             logger.error(f"Error running bot: {e}")
     
+    async def post_init(self, application: Application) -> None:
+        """Pre-render image CAPTCHAs if any group uses them; serve metrics when polling"""
+        # stop() schedules the shutdown on this loop
+        self._loop = asyncio.get_running_loop()
+        try:
+            if await self.storage.settings.any_chat_with('captcha_mode', 'image'):
+                self.captcha_pool.start()
+        except Exception as e:
+            logger.error(f"Error starting CAPTCHA pool: {e}")
+        
+        # run_webhook_async creates _stop_event before calling this and serves
+        # /metrics itself
+        if METRICS_PORT and self._stop_event is None:
+            try:
+                web_app = create_web_app(application, None, None, self.update_stats, self.outbound, REGISTRY)
+                self._metrics_runner = await start_web_server(web_app, METRICS_PORT)
+            except Exception as e:
+                logger.error(f"Error starting metrics server: {e}")
+
+    async def post_stop(self, application: Application) -> None:
+        """Let queued outbound calls go out while the bot can still send"""
+        try:
+            await self.outbound.close()
+            logger.info(f"Outbound queue closed: {self.outbound.snapshot()}")
+        except Exception as e:
+            logger.error(f"Error closing outbound queue: {e}")
+
+    async def post_shutdown(self, application: Application) -> None:
+        """Close storage once the application has shut down"""
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+        self.captcha_pool.close()
+        self.close_storage()
+
+    def close_storage(self):
+        """Finish pending database writes and close connections"""
+        try:
+            if hasattr(self, 'storage'):
+                self.storage.close()
+                logger.info("Storage closed")
+        except Exception as e:
+            logger.error(f"Error closing storage: {e}")
+
     def stop(self):
         """Stop the bot gracefully"""
         try:
-            if hasattr(self, 'application') and self.application.running:
-                self.application.stop()
-                logger.info("Bot stopped gracefully")
+            if self._loop is None:
+                return  # not started
+            
+            if self._stop_event:
+                # Webhook mode: run_webhook_async shuts everything down
+                self._loop.call_soon_threadsafe(self._stop_event.set)
+            else:
+                # Polling: run_polling stops, shuts down and closes storage in post_shutdown
+                self._loop.call_soon_threadsafe(self.application.stop_running)
+            logger.info("Bot stopping")
         except Exception as e:
             logger.error(f"Error stopping bot: {e}")
 
@@ -1607,8 +2402,11 @@ if __name__ == '__main__':
     if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         print("❌ Please set your BOT_TOKEN environment variable!")
     else:
-        bot = AdvancedWelcomeSecurityBot(BOT_TOKEN)
-        bot.run()
+        bot = AdvancedWelcomeSecurityBot(BOT_TOKEN, base_url=BOT_API_URL)
+        if WEBHOOK_URL:
+            bot.run_webhook()
+        else:
+            bot.run()
 
 
 
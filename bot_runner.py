@@ -23,8 +23,11 @@ def run_bot():
             return
         
         print("🤖 Starting Telegram Bot...")
-        bot = AdvancedWelcomeSecurityBot(BOT_TOKEN)
-        bot.run()
+        bot = AdvancedWelcomeSecurityBot(BOT_TOKEN, base_url=os.getenv('BOT_API_URL'))
+        if os.getenv('WEBHOOK_URL'):
+            bot.run_webhook()
+        else:
+            bot.run()
         
     except Exception as e:
         print(f"❌ Error running bot: {e}")
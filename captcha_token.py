@@ -0,0 +1,79 @@
+import hashlib
+import hmac
+from typing import NamedTuple, Optional
+
+# Telegram limits callback_data to 64 bytes
+MAX_CALLBACK_DATA = 64
+MAX_ENTERED_DIGITS = 6
+SUBMIT_KEY = 's'
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _to_base36(value: int) -> str:
+    if value < 0:
+        raise ValueError("base36 values must be non-negative")
+    digits = ''
+    while True:
+        value, rem = divmod(value, 36)
+        digits = _BASE36[rem] + digits
+        if not value:
+            return digits
+
+
+class CaptchaPress(NamedTuple):
+    user_id: int
+    deadline: int
+    entered: str
+    key: str
+    tag: str
+
+
+class CaptchaSigner:
+    """Signs CAPTCHA keypad state into callback_data.
+
+    Each button carries the target user, the deadline, the digits entered so
+    far, its own key and an HMAC tag of the expected answer, all covered by a
+    signature. Any instance holding the same secret can verify a press and
+    check the answer without shared memory.
+
+    Layout: captcha_<user36>_<deadline36>_<entered>_<key>_<tag>_<sig>
+    """
+
+    def __init__(self, secret: bytes, tag_length: int = 8, sig_length: int = 10):
+        self.secret = secret
+        self.tag_length = tag_length
+        self.sig_length = sig_length
+
+    def _mac(self, message: str, length: int) -> str:
+        return hmac.new(self.secret, message.encode(), hashlib.sha256).hexdigest()[:length]
+
+    def answer_tag(self, chat_id: int, user_id: int, deadline: int, answer: str) -> str:
+        return self._mac(f"answer:{chat_id}:{user_id}:{deadline}:{answer}", self.tag_length)
+
+    def encode(self, chat_id: int, user_id: int, deadline: int, entered: str, key: str, tag: str) -> str:
+        payload = f"captcha_{_to_base36(user_id)}_{_to_base36(deadline)}_{entered}_{key}_{tag}"
+        data = f"{payload}_{self._mac(f'{chat_id}:{payload}', self.sig_length)}"
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError("CAPTCHA callback_data too long")
+        return data
+
+    def decode(self, chat_id: int, data: str) -> Optional[CaptchaPress]:
+        """Verify and parse callback_data pressed in chat_id; None if forged or malformed"""
+        payload, _, sig = data.rpartition('_')
+        expected = self._mac(f"{chat_id}:{payload}", self.sig_length)
+        if not hmac.compare_digest(sig, expected):
+            return None
+
+        parts = payload.split('_')
+        if len(parts) != 6 or parts[0] != 'captcha':
+            return None
+        _, user36, deadline36, entered, key, tag = parts
+        try:
+            return CaptchaPress(int(user36, 36), int(deadline36, 36), entered, key, tag)
+        except ValueError:
+            return None
+
+    def is_correct(self, chat_id: int, press: CaptchaPress) -> bool:
+        tag = self.answer_tag(chat_id, press.user_id, press.deadline, press.entered)
+        return hmac.compare_digest(tag, press.tag)
@@ -0,0 +1,255 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from telegram.ext import Application, ApplicationHandlerStop, BaseHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a cached in-memory check up to a slow Bot API round trip
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Monotonic count per label combination"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: Any, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: Any) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, labels)} {value:g}" for labels, value in items]
+
+
+class Histogram:
+    """Observations per label combination, counted into cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[label_values] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *label_values: Any) -> int:
+        entry = self._values.get(label_values)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = []
+        names = self.label_names + ('le',)
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text format.
+
+    Collectors are callables returning (name, kind, help, label names,
+    [(label values, value)]) for numbers that live elsewhere, e.g. cache
+    counters, and are read at render time.
+    """
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._collectors: List[Callable[[], Iterable[Tuple]]] = []
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        families: Dict[str, Tuple[str, str, List[str]]] = {}
+        for metric in self._metrics:
+            families[metric.name] = (metric.kind, metric.help_text, metric.samples())
+        for collector in self._collectors:
+            try:
+                for name, kind, help_text, label_names, values in collector():
+                    lines = families.setdefault(name, (kind, help_text, []))[2]
+                    lines.extend(f"{name}{_labels(label_names, labels)} {value:g}" for labels, value in values)
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {e}")
+
+        out = []
+        for name, (kind, help_text, lines) in families.items():
+            if not lines:
+                continue
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return '\n'.join(out) + '\n' if out else ''
+
+
+REGISTRY = Registry()
+
+HANDLER_CALLS = REGISTRY.counter('bot_handler_calls_total', 'Handler callback invocations', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', 'Handler callbacks that raised', ('handler',))
+HANDLER_SECONDS = REGISTRY.histogram('bot_handler_seconds', 'Handler callback run time', ('handler',))
+API_SECONDS = REGISTRY.histogram('bot_api_request_seconds', 'Bot API request latency', ('method',))
+API_RESPONSES = REGISTRY.counter('bot_api_responses_total', 'Bot API responses by HTTP status', ('method', 'status'))
+DB_SECONDS = REGISTRY.histogram('bot_db_query_seconds', 'SQLite query time', ('kind', 'query'))
+DB_COMMIT_SECONDS = REGISTRY.histogram('bot_db_commit_seconds', 'SQLite group commit time')
+CACHE_REQUESTS = REGISTRY.counter('bot_cache_requests_total', 'In-memory cache lookups', ('cache', 'result'))
+
+
+def query_name(fn: Callable) -> str:
+    """Metric label for a storage query, e.g. SettingsRepository.load"""
+    name = getattr(fn, '__qualname__', None) or getattr(fn, '__name__', 'query')
+    return name.split('.<locals>')[0]
+
+
+def instrument_callback(name: str, callback: Callable) -> Callable:
+    """Wrap a handler callback to count calls and errors and time it"""
+    if getattr(callback, '_instrumented', False):
+        return callback
+
+    @functools.wraps(callback)
+    async def wrapper(update: object, context: Any) -> Any:
+        HANDLER_CALLS.inc(name)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler: BaseHandler) -> int:
+    if isinstance(handler, ConversationHandler):
+        children = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            children.extend(state_handlers)
+        return sum(_instrument_handler(child) for child in children)
+    callback = getattr(handler, 'callback', None)
+    if callback is None:
+        return 0
+    name = getattr(callback, '__name__', type(handler).__name__)
+    handler.callback = instrument_callback(name, callback)
+    return 1
+
+
+def instrument_handlers(application: Application) -> int:
+    """Wrap the callback of every registered handler; returns how many were wrapped"""
+    return sum(
+        _instrument_handler(handler)
+        for group in application.handlers.values()
+        for handler in group
+    )
+
+
+def register_cache(name: str, cache: Any) -> None:
+    """Export a cache's hits/misses (from its snapshot()) and hit ratio"""
+    def collect():
+        stats = cache.snapshot()
+        lookups = stats['hits'] + stats['misses']
+        yield ('bot_cache_requests_total', 'counter', 'In-memory cache lookups', ('cache', 'result'),
+               [((name, 'hit'), stats['hits']), ((name, 'miss'), stats['misses'])])
+        yield ('bot_cache_hit_ratio', 'gauge', 'Share of cache lookups answered from memory', ('cache',),
+               [((name,), stats['hits'] / lookups if lookups else 0)])
+        if 'evictions' in stats:
+            yield ('bot_cache_evictions_total', 'counter', 'Entries dropped to stay within the size limit',
+                   ('cache',), [((name,), stats['evictions'])])
+        if 'size' in stats:
+            yield ('bot_cache_size', 'gauge', 'Entries held in memory', ('cache',), [((name,), stats['size'])])
+    REGISTRY.add_collector(collect)
+
+
+def _counter_hit_ratios():
+    # Hit ratio for caches counted directly through CACHE_REQUESTS
+    caches = {labels[0] for labels in list(CACHE_REQUESTS._values)}
+    values = []
+    for cache in sorted(caches):
+        hits = CACHE_REQUESTS.value(cache, 'hit')
+        lookups = hits + CACHE_REQUESTS.value(cache, 'miss')
+        values.append(((cache,), hits / lookups if lookups else 0))
+    yield ('bot_cache_hit_ratio', 'gauge', 'Share of cache lookups answered from memory', ('cache',), values)
+
+
+REGISTRY.add_collector(_counter_hit_ratios)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest recording latency and status of every Bot API call"""
+
+    async def do_request(self, url: str, method: str, request_data: Optional[Any] = None, *args: Any,
+                         **kwargs: Any) -> Tuple[int, bytes]:
+        # The URL ends in the API method; the token in front of it stays out of labels
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, api_method)
+            API_RESPONSES.inc(api_method, status)
@@ -0,0 +1,373 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first
+MODERATION = 0  # deletes, restricts, bans
+NOTICE = 1      # CAPTCHAs and warnings
+WELCOME = 2     # greetings
+
+# Telegram: about 30 messages per second overall, 20 per minute in one group
+GLOBAL_RATE = 30.0
+CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+
+
+class OutboundDropped(Exception):
+    """A queued call was dropped before it was sent"""
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Call:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'args', 'kwargs',
+                 'future', 'expires', 'coalesce_key', 'attempts')
+
+    def __init__(self, priority, seq, chat_id, method, args, kwargs, future, expires, coalesce_key):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.expires = expires
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+
+    @property
+    def is_message(self) -> bool:
+        # send_message, send_photo, ... count against the per-chat limit
+        return self.method.__name__.startswith('send_')
+
+
+class _ChatQueue:
+    __slots__ = ('calls', 'bucket', 'blocked_until', 'busy')
+
+    def __init__(self, bucket: TokenBucket):
+        self.calls: List[Tuple[int, int, _Call]] = []
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        self.busy = False  # a call to this chat is in flight
+
+    def ready_at(self, now: float) -> float:
+        """When the next call may go out: after any RetryAfter, and a token if it's a message"""
+        ready = self.blocked_until
+        if self.calls and self.calls[0][2].is_message:
+            ready = max(ready, now + self.bucket.delay(now))
+        return ready
+
+
+class OutboundQueue:
+    """Central queue for Bot API calls made on the bot's own initiative.
+
+    Calls go out highest priority first, subject to a global token bucket
+    and, for messages, one per chat. Each chat has at most one call in
+    flight, so e.g. a ban and the unban after it arrive in order. A
+    RetryAfter pauses that chat and puts
+    the call back at the front; calls sharing a coalesce_key while queued
+    are sent once; calls given a ttl are dropped if they can't go out in
+    time. submit() returns a future for the call's result.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: int = CHAT_BURST,
+        max_pending: int = 5000,
+        max_in_flight: int = 16,
+        max_retries: int = 3
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._chats: Dict[Hashable, _ChatQueue] = {}
+        self._ready: List[Tuple[int, int, Hashable]] = []   # (priority, seq, chat) of sendable heads
+        self._waiting: List[Tuple[float, Hashable]] = []    # (ready_at, chat) of paused chats
+        self._by_key: Dict[Hashable, _Call] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._last_cleanup = time.monotonic()
+        self.pending = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    def submit(
+        self,
+        priority: int,
+        method: Callable,
+        chat_id: int,
+        *args: Any,
+        coalesce_key: Optional[Hashable] = None,
+        ttl: Optional[float] = None,
+        **kwargs: Any
+    ) -> asyncio.Future:
+        """Queue method(chat_id, *args, **kwargs); returns a future for its result"""
+        self._start()
+        if coalesce_key is not None and coalesce_key in self._by_key:
+            self.coalesced += 1
+            return self._by_key[coalesce_key].future
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        if self.pending >= self.max_pending and priority != MODERATION:
+            self.dropped += 1
+            future.set_exception(OutboundDropped("outbound queue full"))
+            return future
+
+        now = time.monotonic()
+        call = _Call(
+            priority, next(self._seq), chat_id, method, args, kwargs, future,
+            now + ttl if ttl is not None else None, coalesce_key
+        )
+        if coalesce_key is not None:
+            self._by_key[coalesce_key] = call
+
+        chat = self._chat(chat_id)
+        heapq.heappush(chat.calls, (call.priority, call.seq, call))
+        self.pending += 1
+        self.queued += 1
+        self._schedule(chat_id, chat, now)
+        return future
+
+    def _chat(self, chat_id: Hashable) -> _ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = _ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+            self._chats[chat_id] = chat
+        return chat
+
+    def _start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def _schedule(self, chat_id: Hashable, chat: _ChatQueue, now: float) -> None:
+        """Put a chat's head call on the ready heap, or park the chat until it may send"""
+        if not chat.calls or chat.busy:
+            # A busy chat is rescheduled when its call finishes
+            return
+        ready_at = chat.ready_at(now)
+        if ready_at <= now:
+            priority, seq, _ = chat.calls[0]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, chat_id))
+        self._wakeup.set()
+
+    def _pop_ready(self, now: float) -> Optional[_Call]:
+        while self._waiting and self._waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self._waiting)
+            chat = self._chats.get(chat_id)
+            if chat:
+                self._schedule(chat_id, chat, now)
+
+        while self._ready:
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if not chat or chat.busy or not chat.calls or chat.calls[0][1] != seq:
+                continue  # stale: that call already went out, or one is in flight
+            if chat.ready_at(now) > now:
+                self._schedule(chat_id, chat, now)
+                continue
+
+            _, _, call = heapq.heappop(chat.calls)
+            self.pending -= 1
+            if call.coalesce_key is not None:
+                self._by_key.pop(call.coalesce_key, None)
+            if call.expires is not None and now > call.expires:
+                self.dropped += 1
+                call.future.set_exception(OutboundDropped("expired in outbound queue"))
+                self._schedule(chat_id, chat, now)
+                continue
+
+            if call.is_message:
+                chat.bucket.take(now)
+            chat.busy = True
+            return call
+        return None
+
+    def _cleanup(self, now: float) -> None:
+        """Forget idle chats whose limits have fully recovered"""
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.calls and not chat.busy and chat.blocked_until <= now and chat.bucket.full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+        self._last_cleanup = now
+
+    async def _next_call(self) -> _Call:
+        while True:
+            now = time.monotonic()
+            call = self._pop_ready(now)
+            if call:
+                return call
+
+            if now - self._last_cleanup > 60:
+                self._cleanup(now)
+            timeout = self._waiting[0][0] - now if self._waiting else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            await self._slots.acquire()
+            try:
+                delay = self._global.delay(time.monotonic())
+                if delay:
+                    await asyncio.sleep(delay)
+                call = await self._next_call()
+            except BaseException:
+                self._slots.release()
+                raise
+            self._global.take(time.monotonic())
+            self.in_flight += 1
+            asyncio.get_running_loop().create_task(self._send(call))
+
+    async def _send(self, call: _Call) -> None:
+        try:
+            result = await call.method(call.chat_id, *call.args, **call.kwargs)
+        except RetryAfter as e:
+            self.retried += 1
+            call.attempts += 1
+            if call.attempts > self.max_retries:
+                self.dropped += 1
+                logger.error(f"Error in outbound {call.method.__name__} for chat {call.chat_id}: gave up after {e}")
+                call.future.set_exception(e)
+                return
+            # Pause the chat and retry this call first once the wait is over
+            chat = self._chat(call.chat_id)
+            chat.blocked_until = max(chat.blocked_until, time.monotonic() + e.retry_after)
+            heapq.heappush(chat.calls, (call.priority, call.seq, call))
+            self.pending += 1
+            # Queued again, so duplicates coalesce into it again
+            if call.coalesce_key is not None:
+                self._requeue_key(call)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error in outbound {call.method.__name__} for chat {call.chat_id}: {e}")
+            call.future.set_exception(e)
+        else:
+            self.sent += 1
+            call.future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            chat = self._chat(call.chat_id)
+            chat.busy = False
+            self._schedule(call.chat_id, chat, time.monotonic())
+
+    def _requeue_key(self, call: _Call) -> None:
+        """Give a re-queued call its coalesce_key back, absorbing a duplicate submitted meanwhile"""
+        newer = self._by_key.get(call.coalesce_key)
+        self._by_key[call.coalesce_key] = call
+        if newer is None or newer is call:
+            return
+        chat = self._chats.get(newer.chat_id)
+        entry = (newer.priority, newer.seq, newer)
+        if chat is None or entry not in chat.calls:
+            return
+        # Any stale _ready entry for it is skipped by _pop_ready
+        chat.calls.remove(entry)
+        heapq.heapify(chat.calls)
+        self.pending -= 1
+        self.coalesced += 1
+        call.future.add_done_callback(lambda future: _copy_result(future, newer.future))
+
+    def snapshot(self) -> Dict[str, int]:
+        """Counters for health checks and metrics"""
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+        }
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Give queued calls up to `timeout` seconds to go out, then drop the rest"""
+        deadline = time.monotonic() + timeout
+        while (self.pending or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        for chat in self._chats.values():
+            for _, _, call in chat.calls:
+                self.dropped += 1
+                call.future.set_exception(OutboundDropped("outbound queue closed"))
+            chat.calls.clear()
+        self.pending = 0
+        self._by_key.clear()
+        self._ready.clear()
+        self._waiting.clear()
+
+
+def _copy_result(source: asyncio.Future, target: asyncio.Future) -> None:
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _consume_exception(future: asyncio.Future) -> None:
+    # Failures are logged by the queue; callers that don't await shouldn't
+    # trigger "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
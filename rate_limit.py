@@ -0,0 +1,50 @@
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, Optional
+
+
+class SlidingWindowLimiter:
+    """Sliding-window message counter keyed by (chat_id, user_id).
+
+    Each key keeps the timestamps of its recent messages, capped at
+    limit + 1 entries, so a flood can't grow a single window. Keys idle for
+    longer than idle_ttl are dropped by evict_idle().
+    """
+
+    def __init__(self, idle_ttl: float = 300.0):
+        self.idle_ttl = idle_ttl
+        self._windows: Dict[Hashable, Deque[float]] = {}
+
+    def hit(self, key: Hashable, limit: int, window: float, now: Optional[float] = None) -> bool:
+        """Record one message; True if key sent more than limit messages within window seconds"""
+        if now is None:
+            now = time.monotonic()
+
+        timestamps = self._windows.get(key)
+        if timestamps is None:
+            timestamps = deque()
+            self._windows[key] = timestamps
+
+        cutoff = now - window
+        while timestamps and timestamps[0] <= cutoff:
+            timestamps.popleft()
+
+        timestamps.append(now)
+        if len(timestamps) > limit + 1:
+            timestamps.popleft()
+
+        return len(timestamps) > limit
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Drop keys with no message in the last idle_ttl seconds; returns how many"""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.idle_ttl
+        idle = [key for key, timestamps in self._windows.items()
+                if not timestamps or timestamps[-1] <= cutoff]
+        for key in idle:
+            del self._windows[key]
+        return len(idle)
+
+    def __len__(self) -> int:
+        return len(self._windows)
@@ -0,0 +1,776 @@
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from metrics import DB_COMMIT_SECONDS, DB_SECONDS, query_name
+
+logger = logging.getLogger(__name__)
+
+# Applied to every connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class Database:
+    """SQLite access that never runs on the event loop.
+
+    A single writer thread owns the only write connection, so writes are
+    serialized without locks. Queued writes are group-committed: everything
+    that arrives within flush_interval (up to batch_size writes) runs in one
+    transaction with one commit. Reads run on a small thread pool where every
+    thread has its own read connection, so nothing is shared between
+    concurrent coroutines.
+    """
+
+    def __init__(self, path: str, read_workers: int = 2,
+                 flush_interval: float = 0.2, batch_size: int = 200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._write_queue: "queue.Queue[Optional[Tuple[Optional[Callable], Future]]]" = queue.Queue()
+        self._local = threading.local()
+        self._read_conns: List[sqlite3.Connection] = []
+        self._read_conns_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(
+            max_workers=read_workers,
+            thread_name_prefix='db-read'
+        )
+        self._writer = threading.Thread(target=self._writer_loop, name='db-write', daemon=True)
+        self._closed = False
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers run while the writer commits
+        conn.execute("PRAGMA journal_mode = WAL")
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _writer_loop(self) -> None:
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            running = True
+            while running:
+                item = self._write_queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                # Collect until the batch is full, the interval is over or a
+                # flush is requested
+                while len(batch) < self.batch_size and batch[-1][0] is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._write_queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        running = False
+                        break
+                    batch.append(item)
+                self._commit_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn: sqlite3.Connection,
+                      batch: List[Tuple[Optional[Callable], Future]]) -> None:
+        results = []
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN")
+            for fn, future in batch:
+                if fn is None or not future.set_running_or_notify_cancel():
+                    results.append((future, None, None))
+                    continue
+                # A savepoint per write, so one failing write doesn't roll
+                # back the rest of the batch
+                conn.execute("SAVEPOINT write_item")
+                write_started = time.perf_counter()
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute("RELEASE write_item")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_item")
+                    conn.execute("RELEASE write_item")
+                    logger.error(f"Database write failed: {e}")
+                    results.append((future, None, e))
+                DB_SECONDS.observe(time.perf_counter() - write_started, 'write', query_name(fn))
+            conn.execute("COMMIT")
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"Database batch commit failed: {e}")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for fn, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif future.running():
+                future.set_result(result)
+            else:
+                # Flush markers were never set running
+                future.set_running_or_notify_cancel()
+                future.set_result(None)
+
+    def _read_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def write(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Queue fn(conn) on the writer thread; committed after it returns"""
+        if self._closed:
+            raise RuntimeError("Database is closed")
+        future: Future = Future()
+        self._write_queue.put((fn, future))
+        return future
+
+    def flush(self) -> Future:
+        """Commit everything queued so far; resolves once it is on disk"""
+        future: Future = Future()
+        if self._closed:
+            future.set_result(None)
+            return future
+        self._write_queue.put((None, future))
+        return future
+
+    def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Run fn(conn) on a reader thread with its own connection"""
+        return self._readers.submit(self._timed_read, fn)
+
+    def _timed_read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return fn(self._read_conn())
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, 'read', query_name(fn))
+
+    async def awrite(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        return await asyncio.wrap_future(self.write(fn))
+
+    async def aread(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        return await asyncio.wrap_future(self.read(fn))
+
+    async def aflush(self) -> None:
+        await asyncio.wrap_future(self.flush())
+
+    def close(self) -> None:
+        """Finish queued writes and close all connections"""
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+
+
+class PendingWrites:
+    """The latest uncommitted write per key.
+
+    A cache reloading a key it dropped waits for that key's write to commit
+    instead of flushing the whole queue, so misses on keys with nothing
+    queued (most of them) cost no extra commit.
+    """
+
+    def __init__(self):
+        self._futures: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def track(self, key: Hashable, future: Future) -> Future:
+        with self._lock:
+            self._futures[key] = future
+        future.add_done_callback(lambda done: self._committed(key, done))
+        return future
+
+    def _committed(self, key: Hashable, future: Future) -> None:
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+    async def wait(self, key: Hashable) -> None:
+        """Return once the key's queued writes are committed (or failed)"""
+        future = self._futures.get(key)
+        if future is not None and not future.done():
+            await asyncio.wait([asyncio.wrap_future(future)])
+
+    def wait_blocking(self, key: Hashable) -> None:
+        future = self._futures.get(key)
+        if future is not None:
+            wait_futures([future])
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+
+def _json_load(value: Optional[str]) -> Any:
+    return json.loads(value) if value else None
+
+
+def _json_dump(value: Any) -> Optional[str]:
+    return json.dumps(value) if value else None
+
+
+# group_settings column -> (default, decode from SQLite, encode for SQLite).
+# Adding a setting is a migration plus one entry here.
+SETTINGS_COLUMNS: Dict[str, Tuple[Any, Optional[Callable], Optional[Callable]]] = {
+    'welcome_enabled': (True, bool, None),
+    'welcome_text': (None, None, None),
+    'welcome_media': (None, _json_load, _json_dump),
+    'welcome_buttons': (None, _json_load, _json_dump),
+    'rules_text': (None, None, None),
+    'max_warnings': (3, lambda v: v or 3, None),
+    'security_level': (1, lambda v: v or 1, None),
+    'antispam_enabled': (True, bool, None),
+    'captcha_enabled': (False, bool, None),
+    'spam_max_messages': (5, lambda v: v or 5, None),
+    'spam_window_seconds': (10, lambda v: v or 10, None),
+    'captcha_fail_action': ('kick', lambda v: v or 'kick', None),
+    'captcha_mode': ('math', lambda v: v or 'math', None),
+    'welcome_batch_window': (10, lambda v: 10 if v is None else v, None),
+    'welcome_batch_max': (20, lambda v: v or 20, None),
+    'welcome_keep_last': (False, bool, None),
+    'last_welcome_message_id': (None, None, None),
+    'welcome_media_failures': (0, lambda v: v or 0, None),
+}
+
+
+class SettingsRepository:
+    """Per-chat group settings"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._pending = PendingWrites()
+
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> Dict[str, Any]:
+        settings = {}
+        for column, (_, decode, _) in SETTINGS_COLUMNS.items():
+            value = row[column]
+            settings[column] = decode(value) if decode else value
+        return settings
+
+    def _load_query(self, chat_id: int) -> Callable[[sqlite3.Connection], Optional[Dict[str, Any]]]:
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            row = conn.execute("SELECT * FROM group_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+            return self._decode(row) if row else None
+        return query
+
+    async def load(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """One chat's settings, or None if it has never been configured"""
+        # Saves are queued; reading before they commit would bring back old settings
+        await self._pending.wait(chat_id)
+        return await self.db.aread(self._load_query(chat_id))
+
+    def load_blocking(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """load() for synchronous callers; blocks until SQLite answers"""
+        self._pending.wait_blocking(chat_id)
+        return self.db.read(self._load_query(chat_id)).result()
+
+    async def any_chat_with(self, column: str, value: Any) -> bool:
+        """Whether some chat has `column` set to `value`"""
+        if column not in SETTINGS_COLUMNS:
+            raise ValueError(f"Unknown setting {column}")
+
+        def query(conn: sqlite3.Connection) -> bool:
+            return conn.execute(
+                f"SELECT 1 FROM group_settings WHERE {column} = ? LIMIT 1", (value,)
+            ).fetchone() is not None
+        return await self.db.aread(query)
+
+    def save(self, chat_id: int, settings: Dict[str, Any]) -> Future:
+        columns = list(SETTINGS_COLUMNS)
+        values = [chat_id]
+        for column, (default, _, encode) in SETTINGS_COLUMNS.items():
+            value = settings.get(column, default)
+            values.append(encode(value) if encode else value)
+
+        sql = (
+            f"INSERT OR REPLACE INTO group_settings (chat_id, {', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(values))})"
+        )
+
+        def query(conn: sqlite3.Connection) -> None:
+            conn.execute(sql, values)
+        return self._pending.track(chat_id, self.db.write(query))
+
+
+class WarningRepository:
+    """User warnings per chat.
+
+    Inserts are write-behind: they are queued for the next group commit and
+    the caller gets the new count from memory right away, so threshold
+    checks don't wait for the disk. Counts of the most recently warned
+    users are kept, up to max_cached.
+    """
+
+    def __init__(self, db: Database, max_cached: int = 10000):
+        self.db = db
+        self._counts = ChatCache(self._load_count, max_cached)
+        self._pending = PendingWrites()
+
+    async def _load_count(self, key: Tuple[int, int]) -> int:
+        def query(conn: sqlite3.Connection) -> int:
+            row = conn.execute(
+                "SELECT count FROM warning_counts WHERE chat_id = ? AND user_id = ?", key
+            ).fetchone()
+            return row[0] if row else 0
+        # A dropped count may have inserts that aren't committed yet
+        await self._pending.wait(key)
+        return await self.db.aread(query)
+
+    async def count(self, chat_id: int, user_id: int) -> int:
+        return await self._counts.load((chat_id, user_id), 0)
+
+    async def add(self, chat_id: int, user_id: int, reason: str, admin_id: int) -> int:
+        """Queue a warning and return the user's new warning count"""
+        count = await self.count(chat_id, user_id) + 1
+
+        def query(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "INSERT INTO user_warnings (user_id, chat_id, reason, admin_id) VALUES (?, ?, ?, ?)",
+                (user_id, chat_id, reason, admin_id)
+            )
+        self._pending.track((chat_id, user_id), self.db.write(query))
+
+        self._counts[(chat_id, user_id)] = count
+        return count
+
+    async def list(self, chat_id: int, user_id: int) -> List[Tuple[str, str]]:
+        """Return (reason, timestamp) of a user's warnings, newest first"""
+        await self._pending.wait((chat_id, user_id))
+
+        def query(conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+            return conn.execute(
+                "SELECT reason, timestamp FROM user_warnings WHERE user_id = ? AND chat_id = ? ORDER BY timestamp DESC",
+                (user_id, chat_id)
+            ).fetchall()
+        return await self.db.aread(query)
+
+    async def clear(self, chat_id: int, user_id: int) -> None:
+        def query(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "DELETE FROM user_warnings WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id)
+            )
+        self._counts[(chat_id, user_id)] = 0
+        self._pending.track((chat_id, user_id), self.db.write(query))
+
+    async def chat_stats(self, chat_id: int) -> Tuple[int, int]:
+        """Return (total warnings, warned users) for a chat"""
+        await self.db.aflush()
+
+        def query(conn: sqlite3.Connection) -> Tuple[int, int]:
+            # Range scan over the warning_counts primary key, not user_warnings
+            total, users = conn.execute(
+                "SELECT COALESCE(SUM(count), 0), COUNT(*) FROM warning_counts WHERE chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+            return total, users
+        return await self.db.aread(query)
+
+
+class BannedWordRepository:
+    """Banned words per chat"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def _load_query(chat_id: int) -> Callable[[sqlite3.Connection], List[Dict[str, str]]]:
+        def query(conn: sqlite3.Connection) -> List[Dict[str, str]]:
+            return [
+                {'word': word, 'action': action}
+                for word, action in conn.execute(
+                    "SELECT word, action FROM banned_words WHERE chat_id = ?", (chat_id,)
+                )
+            ]
+        return query
+
+    async def load(self, chat_id: int) -> List[Dict[str, str]]:
+        # add() and remove() wait for their commit, so nothing is pending here
+        return await self.db.aread(self._load_query(chat_id))
+
+    def load_blocking(self, chat_id: int) -> List[Dict[str, str]]:
+        """load() for synchronous callers; blocks until SQLite answers"""
+        return self.db.read(self._load_query(chat_id)).result()
+
+    def any_words(self) -> Future:
+        """Whether any chat has banned words; resolves on a reader thread"""
+        def query(conn: sqlite3.Connection) -> bool:
+            return conn.execute("SELECT 1 FROM banned_words LIMIT 1").fetchone() is not None
+        return self.db.read(query)
+
+    async def add(self, chat_id: int, word: str, action: str, created_by: int) -> None:
+        def query(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "INSERT INTO banned_words (chat_id, word, action, created_by) VALUES (?, ?, ?, ?)",
+                (chat_id, word, action, created_by)
+            )
+        await self.db.awrite(query)
+
+    async def remove(self, chat_id: int, word: str) -> None:
+        def query(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "DELETE FROM banned_words WHERE chat_id = ? AND word = ?",
+                (chat_id, word)
+            )
+        await self.db.awrite(query)
+
+
+_MISSING = object()
+
+
+class ChatCache:
+    """Bounded LRU of per-chat data, loaded from SQLite on first access.
+
+    Stands in for the plain dicts that used to hold every chat. load()
+    awaits the loader for a chat that isn't held, so the event loop never
+    waits for SQLite; once loaded, get, [], `in` and setdefault answer from
+    memory. The least recently used chats are dropped once more than
+    max_size are held. Chats the loader has nothing for are remembered as
+    missing, so idle chats don't cost a query per message. Changes are
+    written through by the repositories, so dropping a chat never loses
+    data.
+
+    A synchronous access to a chat that isn't held calls blocking_loader,
+    if given, and otherwise reads as missing; it is only a fallback for
+    chats dropped between load() and their use. Without a loader the cache
+    is a plain bounded LRU.
+    """
+
+    def __init__(self, loader: Optional[Callable[[Hashable], Awaitable[Any]]] = None, max_size: int = 5000,
+                 blocking_loader: Optional[Callable[[Hashable], Any]] = None):
+        self.loader = loader
+        self.blocking_loader = blocking_loader
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.blocking_loads = 0
+
+    async def load(self, chat_id: Hashable, default: Any = None) -> Any:
+        """Like get(), but a chat that isn't held is loaded without blocking"""
+        if chat_id in self._entries:
+            return self.get(chat_id, default)
+        self.misses += 1
+        if self.loader is None:
+            return default
+        value = await self.loader(chat_id)
+        if chat_id in self._entries:
+            # Stored while we were loading; that is newer than what was read
+            value = self._entries[chat_id]
+            self._entries.move_to_end(chat_id)
+        else:
+            value = _MISSING if value is None else value
+            self._store(chat_id, value)
+        return default if value is _MISSING else value
+
+    def _lookup(self, chat_id: Hashable) -> Any:
+        try:
+            value = self._entries[chat_id]
+        except KeyError:
+            self.misses += 1
+            if self.blocking_loader is None:
+                return _MISSING
+            self.blocking_loads += 1
+            value = self.blocking_loader(chat_id)
+            value = _MISSING if value is None else value
+            self._store(chat_id, value)
+            return value
+        self.hits += 1
+        self._entries.move_to_end(chat_id)
+        return value
+
+    def _store(self, chat_id: Hashable, value: Any) -> None:
+        self._entries[chat_id] = value
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, chat_id: Hashable, default: Any = None) -> Any:
+        value = self._lookup(chat_id)
+        return default if value is _MISSING else value
+
+    def __getitem__(self, chat_id: Hashable) -> Any:
+        value = self._lookup(chat_id)
+        if value is _MISSING:
+            raise KeyError(chat_id)
+        return value
+
+    def __contains__(self, chat_id: Hashable) -> bool:
+        return self._lookup(chat_id) is not _MISSING
+
+    def __setitem__(self, chat_id: Hashable, value: Any) -> None:
+        self._store(chat_id, value)
+
+    def setdefault(self, chat_id: Hashable, default: Any) -> Any:
+        value = self._lookup(chat_id)
+        if value is _MISSING:
+            self._store(chat_id, default)
+            return default
+        return value
+
+    def cached(self, chat_id: Hashable, default: Any = None) -> Any:
+        """The value held for a chat, without loading it or counting a lookup"""
+        value = self._entries.get(chat_id, _MISSING)
+        return default if value is _MISSING else value
+
+    def discard(self, chat_id: Hashable) -> None:
+        """Forget a chat so its next access reloads it"""
+        self._entries.pop(chat_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> Dict[str, int]:
+        """Counters for tuning max_size"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'blocking_loads': self.blocking_loads,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+
+class MediaCacheRepository:
+    """file_ids Telegram assigned to local media assets, so each is uploaded once"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def load_all(self) -> Dict[str, Tuple[str, str]]:
+        """Return path -> (fingerprint, file_id)"""
+        def query(conn: sqlite3.Connection) -> Dict[str, Tuple[str, str]]:
+            return {
+                path: (fingerprint, file_id)
+                for path, fingerprint, file_id in conn.execute("SELECT path, fingerprint, file_id FROM media_cache")
+            }
+        return self.db.read(query).result()
+
+    def save(self, path: str, fingerprint: str, media_type: str, file_id: str) -> Future:
+        def query(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "INSERT OR REPLACE INTO media_cache (path, fingerprint, media_type, file_id) VALUES (?, ?, ?, ?)",
+                (path, fingerprint, media_type, file_id)
+            )
+        return self.db.write(query)
+
+
+def migrate_001_initial(conn: sqlite3.Connection) -> None:
+    """Original tables; IF NOT EXISTS because pre-versioning databases have them"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_settings (
+            chat_id INTEGER PRIMARY KEY,
+            welcome_enabled BOOLEAN DEFAULT 1,
+            welcome_text TEXT,
+            welcome_media TEXT,
+            welcome_buttons TEXT,
+            rules_text TEXT,
+            max_warnings INTEGER DEFAULT 3,
+            security_level INTEGER DEFAULT 1,
+            antispam_enabled BOOLEAN DEFAULT 1,
+            captcha_enabled BOOLEAN DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_warnings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            reason TEXT,
+            admin_id INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS banned_words (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            word TEXT,
+            action TEXT DEFAULT 'delete',
+            created_by INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def migrate_002_warning_counts(conn: sqlite3.Connection) -> None:
+    """Indexes for per-chat lookups and the trigger-maintained warning_counts table"""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_warnings_chat_user "
+        "ON user_warnings (chat_id, user_id, timestamp)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_banned_words_chat_word "
+        "ON banned_words (chat_id, word)"
+    )
+
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'warning_counts'"
+    ).fetchone()
+    if exists:
+        return
+
+    conn.execute('''
+        CREATE TABLE warning_counts (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_warnings_insert
+        AFTER INSERT ON user_warnings
+        BEGIN
+            INSERT INTO warning_counts (chat_id, user_id, count)
+            VALUES (NEW.chat_id, NEW.user_id, 1)
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET count = count + 1;
+        END
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_warnings_delete
+        AFTER DELETE ON user_warnings
+        BEGIN
+            UPDATE warning_counts SET count = count - 1
+            WHERE chat_id = OLD.chat_id AND user_id = OLD.user_id;
+            DELETE FROM warning_counts
+            WHERE chat_id = OLD.chat_id AND user_id = OLD.user_id AND count <= 0;
+        END
+    ''')
+
+    # Backfill counts for warnings stored before the table existed
+    conn.execute('''
+        INSERT INTO warning_counts (chat_id, user_id, count)
+        SELECT chat_id, user_id, COUNT(*) FROM user_warnings
+        WHERE chat_id IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY chat_id, user_id
+    ''')
+
+
+def migrate_003_flood_limits(conn: sqlite3.Connection) -> None:
+    """Per-chat anti-spam thresholds"""
+    conn.execute("ALTER TABLE group_settings ADD COLUMN spam_max_messages INTEGER DEFAULT 5")
+    conn.execute("ALTER TABLE group_settings ADD COLUMN spam_window_seconds INTEGER DEFAULT 10")
+
+
+def migrate_004_captcha_fail_action(conn: sqlite3.Connection) -> None:
+    """What to do with users who never solve their CAPTCHA"""
+    conn.execute("ALTER TABLE group_settings ADD COLUMN captcha_fail_action TEXT DEFAULT 'kick'")
+
+
+def migrate_005_captcha_mode(conn: sqlite3.Connection) -> None:
+    """Math or image CAPTCHA per chat"""
+    conn.execute("ALTER TABLE group_settings ADD COLUMN captcha_mode TEXT DEFAULT 'math'")
+
+
+def migrate_006_welcome_batching(conn: sqlite3.Connection) -> None:
+    """Per-chat window and cap for merging join waves into one welcome"""
+    conn.execute("ALTER TABLE group_settings ADD COLUMN welcome_batch_window INTEGER DEFAULT 10")
+    conn.execute("ALTER TABLE group_settings ADD COLUMN welcome_batch_max INTEGER DEFAULT 20")
+
+
+def migrate_007_keep_last_welcome(conn: sqlite3.Connection) -> None:
+    """Optionally delete the previous welcome when a new one is sent"""
+    conn.execute("ALTER TABLE group_settings ADD COLUMN welcome_keep_last BOOLEAN DEFAULT 0")
+    conn.execute("ALTER TABLE group_settings ADD COLUMN last_welcome_message_id INTEGER")
+
+
+def migrate_008_welcome_media(conn: sqlite3.Connection) -> None:
+    """Failed welcome media sends per chat, and file_ids of uploaded local assets"""
+    conn.execute("ALTER TABLE group_settings ADD COLUMN welcome_media_failures INTEGER DEFAULT 0")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+# Schema migrations, applied in order. PRAGMA user_version holds the number
+# of migrations already applied; only append to this list.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    migrate_001_initial,
+    migrate_002_warning_counts,
+    migrate_003_flood_limits,
+    migrate_004_captcha_fail_action,
+    migrate_005_captcha_mode,
+    migrate_006_welcome_batching,
+    migrate_007_keep_last_welcome,
+    migrate_008_welcome_media,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations and return the resulting schema version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this bot ({len(MIGRATIONS)})"
+        )
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+        logger.info(f"Applied database migration {number}: {migration.__name__}")
+    return len(MIGRATIONS)
+
+
+class Storage:
+    """Bot persistence: the database plus one repository per table"""
+
+    def __init__(self, path: str = 'bot_data.db'):
+        self.db = Database(path)
+        # Runs inside one writer transaction: a failing migration leaves the
+        # schema and user_version untouched
+        self.schema_version = self.db.write(migrate).result()
+        self.settings = SettingsRepository(self.db)
+        self.warnings = WarningRepository(self.db)
+        self.banned_words = BannedWordRepository(self.db)
+        self.media_cache = MediaCacheRepository(self.db)
+
+    def close(self) -> None:
+        self.db.close()
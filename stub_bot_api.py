@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+STUB_BOT = {'id': 10, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+# Users getChatMember/getChatAdministrators report as chat owners
+STUB_ADMINS = (1,)
+
+# Telegram's limits, enforced when enforce_limits is on
+GLOBAL_PER_SECOND = 30
+CHAT_PER_MINUTE = 20
+
+
+class StubBotAPI:
+    """Fake Telegram Bot API for load and soak tests, served with aiohttp.
+
+    Answers sendMessage (and the other send* methods), deleteMessage(s),
+    restrictChatMember, banChatMember, unbanChatMember, getChat,
+    getChatMember, getChatAdministrators, getUpdates and getMe with
+    plausible results;
+    any other method succeeds with True. Point the bot at it with
+    Application.builder().base_url(stub.base_url), or the base_url argument
+    of AdvancedWelcomeSecurityBot.
+
+    latency (plus up to jitter) seconds are added to every call.
+    flood_probability answers that share of calls with 429 RetryAfter;
+    enforce_limits answers 429 whenever a send would exceed Telegram's
+    per-chat or global message limits. push_update() queues updates for
+    getUpdates.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        flood_probability: float = 0.0,
+        retry_after: int = 1,
+        enforce_limits: bool = False,
+        seed: Optional[int] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_probability = flood_probability
+        self.retry_after = retry_after
+        self.enforce_limits = enforce_limits
+        self.base_url = None
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates: Deque[Dict[str, Any]] = deque()
+        self._updates_available = asyncio.Event()
+        self._sent_at: Dict[int, Deque[float]] = {}
+        self._global_sent: Deque[float] = deque()
+        self._runner: Optional[web.AppRunner] = None
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+
+    # ===== UPDATES =====
+    def push_update(self, update: Dict[str, Any]) -> int:
+        """Queue an update (without update_id) for getUpdates; returns its update_id"""
+        update_id = next(self._update_ids)
+        self._updates.append(dict(update, update_id=update_id))
+        self._updates_available.set()
+        return update_id
+
+    @property
+    def pending_updates(self) -> int:
+        return len(self._updates)
+
+    async def _get_updates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        # Updates before offset are confirmed
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._updates_available.clear()
+            try:
+                await asyncio.wait_for(self._updates_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    # ===== METHODS =====
+    def _message(self, method: str, params: Dict[str, str]) -> Dict[str, Any]:
+        message_id = next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'supergroup', 'title': 'Stub group'},
+            'from': STUB_BOT,
+        }
+        if method == 'sendMessage':
+            message['text'] = params.get('text', '')
+            return message
+        if params.get('caption'):
+            message['caption'] = params['caption']
+        file = {'file_id': f"stub-file-{message_id}", 'file_unique_id': f"stub-{message_id}"}
+        if method == 'sendPhoto':
+            message['photo'] = [dict(file, width=1, height=1)]
+        elif method in ('sendVideo', 'sendAnimation'):
+            key = 'video' if method == 'sendVideo' else 'animation'
+            message[key] = dict(file, width=1, height=1, duration=1)
+        return message
+
+    def _chat(self, chat_id: int) -> Dict[str, Any]:
+        chat = {'id': chat_id, 'type': 'supergroup', 'title': 'Stub group'}
+        if chat_id < 0:
+            # Default member permissions, which lift_restriction restores
+            chat['permissions'] = {
+                'can_send_messages': True, 'can_send_audios': True, 'can_send_documents': True,
+                'can_send_photos': True, 'can_send_videos': True, 'can_send_video_notes': True,
+                'can_send_voice_notes': True, 'can_send_polls': True, 'can_send_other_messages': True,
+                'can_add_web_page_previews': True, 'can_change_info': False, 'can_invite_users': True,
+                'can_pin_messages': False, 'can_manage_topics': False,
+            }
+        else:
+            chat.update(type='private', first_name=f"User{chat_id}")
+            del chat['title']
+        return chat
+
+    def _member(self, user_id: int) -> Dict[str, Any]:
+        user = STUB_BOT if user_id == STUB_BOT['id'] else {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+        if user_id in STUB_ADMINS:
+            return {'status': 'creator', 'user': user, 'is_anonymous': False}
+        return {'status': 'member', 'user': user}
+
+    async def _result(self, method: str, params: Dict[str, str]) -> Any:
+        if method == 'getMe':
+            return STUB_BOT
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method.startswith('send'):
+            return self._message(method, params)
+        if method == 'getChat':
+            return self._chat(int(params.get('chat_id', 0)))
+        if method == 'getChatMember':
+            return self._member(int(params.get('user_id', 0)))
+        if method == 'getChatAdministrators':
+            return [self._member(user_id) for user_id in STUB_ADMINS]
+        if method == 'getFile':
+            return {'file_id': params.get('file_id', ''), 'file_unique_id': 'stub', 'file_size': 1}
+        return True
+
+    def _throttle(self, method: str, params: Dict[str, str]) -> Optional[int]:
+        """Seconds to answer a RetryAfter with, or None to let the call through"""
+        if method in ('getUpdates', 'getMe'):
+            return None
+        if self.flood_probability and self._random.random() < self.flood_probability:
+            return self.retry_after
+        if not self.enforce_limits or not method.startswith('send'):
+            return None
+
+        now = time.monotonic()
+        while self._global_sent and now - self._global_sent[0] >= 1:
+            self._global_sent.popleft()
+        chat_id = int(params.get('chat_id', 0))
+        sent = self._sent_at.setdefault(chat_id, deque())
+        while sent and now - sent[0] >= 60:
+            sent.popleft()
+        if len(sent) >= CHAT_PER_MINUTE:
+            return max(1, int(60 - (now - sent[0])) + 1)
+        if len(self._global_sent) >= GLOBAL_PER_SECOND:
+            return 1
+        sent.append(now)
+        self._global_sent.append(now)
+        return None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        try:
+            params = dict(await request.post())
+        except ConnectionResetError:
+            return web.Response(status=499)
+        self.calls[method] += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._random.random() * self.jitter)
+
+        retry_after = self._throttle(method, params)
+        if retry_after is not None:
+            self.throttled[method] += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {retry_after}",
+                'parameters': {'retry_after': retry_after},
+            }, status=429)
+        return web.json_response({'ok': True, 'result': await self._result(method, params)})
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.snapshot())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'calls': dict(self.calls),
+            'throttled': dict(self.throttled),
+            'pending_updates': self.pending_updates,
+        }
+
+    # ===== SERVER =====
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        app.router.add_get('/stats', self._stats)
+        return app
+
+    async def start(self, port: int = 8081, host: str = '127.0.0.1') -> str:
+        """Serve on host:port; returns the base_url to give the bot"""
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.base_url = f"http://{host}:{port}/bot"
+        logger.info(f"Stub Bot API listening on {self.base_url}")
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(args: argparse.Namespace) -> None:
+    stub = StubBotAPI(args.latency, args.jitter, args.flood_probability, args.retry_after, args.enforce_limits)
+    await stub.start(args.port, args.host)
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(f"Stub Bot API: {stub.snapshot()}")
+    finally:
+        await stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API for load testing; run the bot with BOT_API_URL=http://HOST:PORT/bot")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many extra seconds per call")
+    parser.add_argument('--flood-probability', type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of injected 429s")
+    parser.add_argument('--enforce-limits', action='store_true', help="429 sends over Telegram's chat and global limits")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
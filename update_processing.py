@@ -0,0 +1,113 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, in order within a chat.
+
+    Every chat gets a FIFO lock, so a chat's updates run one after another
+    in arrival order while other chats proceed. Only updates that hold their
+    chat's lock take one of the max_concurrent_updates running slots, so a
+    flood in one chat can't fill every slot with updates that are just
+    waiting for their turn.
+
+    The base class limit (max_pending_updates) caps how many updates are
+    accepted at once, waiting or running.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: Optional[int] = None):
+        super().__init__(max_pending_updates or max_concurrent_updates * 16)
+        self.max_running_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_pending: Dict[Hashable, int] = {}
+        self._chat_lag: Dict[Hashable, float] = {}
+        self.running = 0
+        self.pending = 0
+        self.processed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Hashable]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        queued_at = time.monotonic()
+        chat_key = self._chat_key(update)
+        self.pending += 1
+        started = False
+
+        if chat_key is None:
+            lock = None
+        else:
+            lock = self._chat_locks.get(chat_key)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._chat_locks[chat_key] = lock
+            self._chat_pending[chat_key] = self._chat_pending.get(chat_key, 0) + 1
+
+        acquired = False
+        try:
+            if lock:
+                await lock.acquire()
+                acquired = True
+            try:
+                async with self._slots:
+                    started = True
+                    lag = time.monotonic() - queued_at
+                    self.pending -= 1
+                    self.running += 1
+                    self.lag_total += lag
+                    self.lag_max = max(self.lag_max, lag)
+                    if chat_key is not None:
+                        self._chat_lag[chat_key] = lag
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+            finally:
+                if acquired:
+                    lock.release()
+        finally:
+            if not started:
+                # Cancelled while waiting for its turn
+                self.pending -= 1
+                if hasattr(coroutine, 'close'):
+                    coroutine.close()
+            if chat_key is not None:
+                remaining = self._chat_pending[chat_key] - 1
+                if remaining:
+                    self._chat_pending[chat_key] = remaining
+                else:
+                    # Nothing else queued for this chat: drop its state
+                    del self._chat_pending[chat_key]
+                    del self._chat_locks[chat_key]
+                    self._chat_lag.pop(chat_key, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Queue depth and lag figures for health checks and metrics"""
+        busiest = max(self._chat_pending.values(), default=0)
+        return {
+            'running': self.running,
+            'pending': self.pending,
+            'active_chats': len(self._chat_pending),
+            'busiest_chat_depth': busiest,
+            'slowest_chat_lag_seconds': max(self._chat_lag.values(), default=0.0),
+            'processed': self.processed,
+            'lag_avg_seconds': self.lag_total / self.processed if self.processed else 0.0,
+            'lag_max_seconds': self.lag_max,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,118 @@
+from collections import Counter
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from telegram import Update
+from telegram.ext import (
+    BaseHandler, CallbackQueryHandler, ChatJoinRequestHandler, ChatMemberHandler,
+    ChosenInlineResultHandler, CommandHandler, ConversationHandler, InlineQueryHandler,
+    MessageHandler, PollAnswerHandler, PollHandler, PreCheckoutQueryHandler,
+    ShippingQueryHandler, TypeHandler, filters
+)
+
+MESSAGE_KINDS = frozenset({
+    Update.MESSAGE, Update.EDITED_MESSAGE, Update.CHANNEL_POST, Update.EDITED_CHANNEL_POST
+})
+
+# Message kinds each UpdateType filter lets through
+_UPDATE_TYPE_FILTERS = {
+    filters.UpdateType.MESSAGE: frozenset({Update.MESSAGE}),
+    filters.UpdateType.EDITED_MESSAGE: frozenset({Update.EDITED_MESSAGE}),
+    filters.UpdateType.MESSAGES: frozenset({Update.MESSAGE, Update.EDITED_MESSAGE}),
+    filters.UpdateType.CHANNEL_POST: frozenset({Update.CHANNEL_POST}),
+    filters.UpdateType.EDITED_CHANNEL_POST: frozenset({Update.EDITED_CHANNEL_POST}),
+    filters.UpdateType.CHANNEL_POSTS: frozenset({Update.CHANNEL_POST, Update.EDITED_CHANNEL_POST}),
+    filters.UpdateType.EDITED: frozenset({Update.EDITED_MESSAGE, Update.EDITED_CHANNEL_POST}),
+}
+
+# Handlers that only ever see one kind of update
+_HANDLER_TYPES = {
+    CallbackQueryHandler: Update.CALLBACK_QUERY,
+    ChatJoinRequestHandler: Update.CHAT_JOIN_REQUEST,
+    ChosenInlineResultHandler: Update.CHOSEN_INLINE_RESULT,
+    InlineQueryHandler: Update.INLINE_QUERY,
+    PollAnswerHandler: Update.POLL_ANSWER,
+    PollHandler: Update.POLL,
+    PreCheckoutQueryHandler: Update.PRE_CHECKOUT_QUERY,
+    ShippingQueryHandler: Update.SHIPPING_QUERY,
+}
+
+
+def filter_update_types(message_filter: Optional[filters.BaseFilter]) -> FrozenSet[str]:
+    """Message kinds a handler filter can accept.
+
+    Only UpdateType filters narrow the result; any other filter is assumed
+    to accept all four kinds, so the answer errs on the side of subscribing.
+    """
+    if message_filter is None:
+        return MESSAGE_KINDS
+    if message_filter in _UPDATE_TYPE_FILTERS:
+        return _UPDATE_TYPE_FILTERS[message_filter]
+    if isinstance(message_filter, filters._MergedFilter):
+        base = filter_update_types(message_filter.base_filter)
+        if message_filter.and_filter is not None:
+            return base & filter_update_types(message_filter.and_filter)
+        return base | filter_update_types(message_filter.or_filter)
+    return MESSAGE_KINDS
+
+
+def handler_update_types(handler: BaseHandler) -> FrozenSet[str]:
+    """Update types a handler can act on"""
+    if isinstance(handler, ConversationHandler):
+        children = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            children.extend(state_handlers)
+        return frozenset().union(*(handler_update_types(child) for child in children))
+    if isinstance(handler, (MessageHandler, CommandHandler)):
+        return filter_update_types(handler.filters)
+    if isinstance(handler, ChatMemberHandler):
+        if handler.chat_member_types == ChatMemberHandler.MY_CHAT_MEMBER:
+            return frozenset({Update.MY_CHAT_MEMBER})
+        if handler.chat_member_types == ChatMemberHandler.CHAT_MEMBER:
+            return frozenset({Update.CHAT_MEMBER})
+        return frozenset({Update.MY_CHAT_MEMBER, Update.CHAT_MEMBER})
+    if isinstance(handler, TypeHandler):
+        # Observers (counters, logging) see whatever the others subscribe to
+        return frozenset()
+    for handler_class, update_type in _HANDLER_TYPES.items():
+        if isinstance(handler, handler_class):
+            return frozenset({update_type})
+    # Unknown handler: don't guess, keep everything
+    return frozenset(Update.ALL_TYPES)
+
+
+def required_update_types(handlers: Iterable[BaseHandler]) -> List[str]:
+    """Minimal allowed_updates covering every handler, in Update.ALL_TYPES order"""
+    needed = frozenset().union(*(handler_update_types(handler) for handler in handlers))
+    return [update_type for update_type in Update.ALL_TYPES if update_type in needed]
+
+
+def update_type(update: Update) -> str:
+    """Name of the field an update carries, e.g. 'message' or 'callback_query'"""
+    for name in Update.ALL_TYPES:
+        if getattr(update, name, None) is not None:
+            return name
+    return 'unknown'
+
+
+class UpdateTypeStats:
+    """Counts received updates per type, and those no handler took"""
+
+    def __init__(self):
+        self.received: Counter = Counter()
+        self.unhandled: Counter = Counter()
+
+    def record_received(self, update: Update) -> None:
+        self.received[update_type(update)] += 1
+
+    def record_unhandled(self, update: Update) -> None:
+        self.unhandled[update_type(update)] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {
+                'received': count,
+                'handled': count - self.unhandled[name],
+                'dropped': self.unhandled[name],
+            }
+            for name, count in sorted(self.received.items())
+        }
@@ -0,0 +1,119 @@
+import hmac
+import logging
+import time
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import Registry
+from outbound import OutboundQueue
+from update_types import UpdateTypeStats
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_web_app(
+    application: Application,
+    webhook_path: Optional[str],
+    secret_token: Optional[str],
+    update_stats: Optional[UpdateTypeStats] = None,
+    outbound: Optional[OutboundQueue] = None,
+    registry: Optional[Registry] = None
+) -> web.Application:
+    """aiohttp app serving Telegram webhook updates plus /health and /metrics.
+
+    Updates are pushed onto the Application's update_queue, so they go
+    through the same processing as polling. update_stats, outbound and
+    registry, if given, add per-type update counts, send queue counters and
+    handler/API/database/cache metrics to /metrics. Without a webhook_path
+    only /health and /metrics are served, e.g. next to polling.
+    """
+    started_at = time.monotonic()
+    received = {'updates': 0, 'rejected': 0}
+
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token, secret_token):
+            received['rejected'] += 1
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            # Not JSON (or not UTF-8) at all
+            received['rejected'] += 1
+            return web.Response(status=400)
+
+        try:
+            if not isinstance(data, dict):
+                raise TypeError(f"expected a JSON object, got {type(data).__name__}")
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            # Answered 200 anyway: Telegram would only retry the same update
+            logger.error(f"Error parsing webhook update: {e}")
+            received['rejected'] += 1
+            return web.Response()
+        await application.update_queue.put(update)
+        received['updates'] += 1
+        return web.Response()
+
+    def processing_stats() -> dict:
+        snapshot = getattr(application.update_processor, 'snapshot', None)
+        return snapshot() if snapshot else {}
+
+    async def health(request: web.Request) -> web.Response:
+        running = application.running
+        return web.json_response(
+            {
+                'status': 'ok' if running else 'stopped',
+                'uptime_seconds': round(time.monotonic() - started_at, 1),
+                'updates_received': received['updates'],
+                'update_queue_size': application.update_queue.qsize(),
+                'processing': processing_stats(),
+            },
+            status=200 if running else 503
+        )
+
+    async def metrics(request: web.Request) -> web.Response:
+        lines = [
+            f"bot_uptime_seconds {time.monotonic() - started_at:.1f}",
+            f"bot_webhook_updates_total {received['updates']}",
+            f"bot_webhook_rejected_total {received['rejected']}",
+            f"bot_update_queue_size {application.update_queue.qsize()}",
+            f"bot_running {int(application.running)}",
+        ]
+        for name, value in processing_stats().items():
+            lines.append(f"bot_updates_{name} {value}")
+        if update_stats:
+            for name, counts in update_stats.snapshot().items():
+                lines.append(f'bot_updates_received_total{{type="{name}"}} {counts["received"]}')
+                lines.append(f'bot_updates_dropped_total{{type="{name}"}} {counts["dropped"]}')
+        if outbound:
+            for name, value in outbound.snapshot().items():
+                lines.append(f"bot_outbound_{name} {value}")
+        text = '\n'.join(lines) + '\n'
+        if registry:
+            text += registry.render()
+        return web.Response(text=text, content_type='text/plain')
+
+    app = web.Application()
+    if webhook_path:
+        app.router.add_post(f"/{webhook_path}", telegram_webhook)
+    app.router.add_get('/', health)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    return app
+
+
+async def start_web_server(web_app: web.Application, port: int, host: str = '0.0.0.0') -> web.AppRunner:
+    """Start serving web_app; call cleanup() on the returned runner to stop"""
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Web server listening on {host}:{port}")
+    return runner
@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from outbound import OutboundQueue
+from storage import MediaCacheRepository
+
+logger = logging.getLogger(__name__)
+
+# Bot method sending each welcome media type
+MEDIA_SENDERS = {
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'animation': 'send_animation',
+}
+
+_EXTENSION_TYPES = {
+    '.gif': 'animation',
+    '.mp4': 'video',
+    '.mov': 'video',
+    '.webm': 'video',
+}
+
+
+def media_type_for_path(path: str) -> str:
+    """Welcome media type of a local asset, from its extension"""
+    return _EXTENSION_TYPES.get(os.path.splitext(path)[1].lower(), 'photo')
+
+
+def sent_file_id(message: Any, media_type: str) -> Optional[str]:
+    """file_id Telegram gave the media of a sent message"""
+    if media_type == 'photo':
+        return message.photo[-1].file_id if message.photo else None
+    if media_type == 'video':
+        return message.video.file_id if message.video else None
+    if media_type == 'animation':
+        return message.animation.file_id if message.animation else None
+    return None
+
+
+def _read_file(path: str) -> Tuple[Tuple[int, int], str, bytes]:
+    """((mtime, size), sha256, contents) of a file; runs on a worker thread"""
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return (stat.st_mtime_ns, stat.st_size), hashlib.sha256(data).hexdigest(), data
+
+
+class MediaLibrary:
+    """Sends welcome media by file_id, uploading local assets only once.
+
+    welcome_media is either {'type', 'file_id'} as sent by an admin or
+    {'type', 'path'} for a file on disk. A local file is uploaded the
+    first time it's used; the file_id Telegram returns is stored with a
+    fingerprint of the file's contents and reused until the file changes.
+    Sends that arrive while the first upload is still queued wait for it
+    instead of uploading the bytes again. Files are read and hashed on a
+    worker thread, never on the event loop.
+    """
+
+    def __init__(self, repository: MediaCacheRepository, outbound: OutboundQueue):
+        self.repository = repository
+        self.outbound = outbound
+        self._file_ids: Dict[str, Tuple[str, str]] = repository.load_all()
+        self._fingerprints: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        self._uploads: Dict[str, asyncio.Future] = {}
+        self.uploads = 0
+        self.reused = 0
+
+    def cached_file_id(self, path: str) -> Optional[str]:
+        """file_id of the file as it is now, if it was hashed and uploaded unchanged"""
+        entry = self._file_ids.get(path)
+        fingerprint = self._fingerprints.get(path)
+        if not entry or not fingerprint:
+            return None
+        stat = os.stat(path)
+        if fingerprint[0] != (stat.st_mtime_ns, stat.st_size) or fingerprint[1] != entry[0]:
+            return None
+        return entry[1]
+
+    def submit(self, bot: Any, chat_id: int, media: Dict[str, str], priority: int, **kwargs: Any) -> asyncio.Future:
+        """Queue a media send; kwargs go to the send method (and ttl to the queue)"""
+        media_type = media['type']
+        method = getattr(bot, MEDIA_SENDERS[media_type])
+        if 'file_id' in media:
+            return self.outbound.submit(priority, method, chat_id, **{media_type: media['file_id']}, **kwargs)
+
+        path = media['path']
+        file_id = self.cached_file_id(path)
+        if file_id:
+            self.reused += 1
+            return self.outbound.submit(priority, method, chat_id, **{media_type: file_id}, **kwargs)
+
+        pending = self._uploads.get(path)
+        if pending is None:
+            upload = asyncio.get_running_loop().create_future()
+            self._uploads[path] = upload
+            upload.add_done_callback(lambda future: self._upload_done(path, future))
+            asyncio.get_running_loop().create_task(self._upload(method, chat_id, media, priority, kwargs, upload))
+            return upload
+
+        # First upload still queued: send once its file_id is known (or upload
+        # ourselves if it failed)
+        result = asyncio.get_running_loop().create_future()
+
+        def send_after_upload(_):
+            try:
+                sent = self.submit(bot, chat_id, media, priority, **kwargs)
+            except Exception as e:
+                result.set_exception(e)
+                return
+            sent.add_done_callback(lambda future: _copy_result(future, result))
+        pending.add_done_callback(send_after_upload)
+        return result
+
+    async def _upload(self, method: Any, chat_id: int, media: Dict[str, str], priority: int,
+                      kwargs: Dict[str, Any], result: asyncio.Future) -> None:
+        """Hash the file off the loop, then send it by file_id if unchanged or upload it"""
+        path = media['path']
+        media_type = media['type']
+        try:
+            key, fingerprint, data = await asyncio.to_thread(_read_file, path)
+            self._fingerprints[path] = (key, fingerprint)
+            entry = self._file_ids.get(path)
+            if entry and entry[0] == fingerprint:
+                # Uploaded before a restart and unchanged since
+                self.reused += 1
+                sent = self.outbound.submit(priority, method, chat_id, **{media_type: entry[1]}, **kwargs)
+            else:
+                self.uploads += 1
+                sent = self.outbound.submit(priority, method, chat_id, **{media_type: data}, **kwargs)
+                sent.add_done_callback(lambda future: self._uploaded(path, fingerprint, media_type, future))
+        except Exception as e:
+            if not result.done():
+                result.set_exception(e)
+            return
+        sent.add_done_callback(lambda future: _copy_result(future, result))
+
+    def _upload_done(self, path: str, future: asyncio.Future) -> None:
+        if self._uploads.get(path) is future:
+            del self._uploads[path]
+        if not future.cancelled():
+            future.exception()  # retrieved; callers that care got it through their callbacks
+
+    def _uploaded(self, path: str, fingerprint: str, media_type: str, future: asyncio.Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        file_id = sent_file_id(future.result(), media_type)
+        if not file_id:
+            return
+        self._file_ids[path] = (fingerprint, file_id)
+        self.repository.save(path, fingerprint, media_type, file_id)
+        logger.info(f"Uploaded {path}; later welcomes reuse its file_id")
+
+
+def _copy_result(source: asyncio.Future, target: asyncio.Future) -> None:
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
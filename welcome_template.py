@@ -0,0 +1,58 @@
+import string
+from typing import Mapping, Tuple
+
+PLACEHOLDERS = ('name', 'username', 'group', 'mention', 'id')
+DEFAULT_WELCOME_TEXT = "Welcome {name} to {group}! 🎉"
+
+
+class TemplateError(ValueError):
+    """A welcome text that can't be compiled"""
+
+
+class WelcomeTemplate:
+    """A welcome text compiled once, rendered by plain substitution.
+
+    The {placeholder} syntax is checked when the template is compiled;
+    render() then only fills a %-format string, so it never raises at join
+    time.
+    """
+
+    __slots__ = ('source', 'fields', '_format')
+
+    def __init__(self, source: str):
+        self.source = source
+        try:
+            parsed = list(string.Formatter().parse(source))
+        except ValueError as e:
+            raise TemplateError(f"Unbalanced braces ({e}); write {{{{ and }}}} for literal braces")
+
+        chunks = []
+        fields = []
+        for literal, field, format_spec, conversion in parsed:
+            chunks.append(literal.replace('%', '%%'))
+            if field is None:
+                continue
+            if field not in PLACEHOLDERS:
+                raise TemplateError(f"Unknown placeholder {{{field}}}")
+            if format_spec or conversion:
+                raise TemplateError(f"Placeholder {{{field}}} can't have a format")
+            chunks.append('%s')
+            fields.append(field)
+
+        self.fields: Tuple[str, ...] = tuple(fields)
+        self._format = ''.join(chunks)
+
+    @classmethod
+    def lenient(cls, source: str) -> 'WelcomeTemplate':
+        """Compile source, or treat it as literal text if it's invalid (e.g. saved before validation)"""
+        try:
+            return cls(source)
+        except TemplateError:
+            template = cls.__new__(cls)
+            template.source = source
+            template.fields = ()
+            template._format = source.replace('%', '%%')
+            return template
+
+    def render(self, values: Mapping[str, str]) -> str:
+        return self._format % tuple([values.get(field, '') for field in self.fields])
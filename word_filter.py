@@ -0,0 +1,182 @@
+import functools
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+# Higher number = more severe action
+ACTION_SEVERITY = {
+    'delete': 0,
+    'warn': 1,
+    'mute': 2,
+}
+
+# Cyrillic and Greek letters that look like Latin ones (after casefolding)
+CONFUSABLES = {
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o',
+    'р': 'p', 'с': 'c', 'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ї': 'i', 'ј': 'j',
+    'ѕ': 's', 'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w', 'ɡ': 'g', 'ı': 'i',
+    'α': 'a', 'β': 'b', 'ε': 'e', 'η': 'n', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o',
+    'ρ': 'p', 'τ': 't', 'υ': 'u', 'χ': 'x', 'ω': 'w',
+}
+
+# Digits and symbols standing in for letters, only inside words that have
+# letters, so numbers stay numbers ("4 cats" has no "a"). 1, | and ! read
+# as "i", and as "l" in a second reading (see normalized_forms). Letters are
+# never folded into other letters, so real words don't turn into banned ones.
+LEET = {
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '6': 'g', '7': 't', '8': 'b', '9': 'g',
+    '@': 'a', '$': 's', '!': 'i', '|': 'i', '+': 't',
+}
+_AMBIGUOUS = '1|!'
+
+_CONFUSABLES = str.maketrans(CONFUSABLES)
+_LEET = {
+    'i': str.maketrans(LEET),
+    'l': str.maketrans({**LEET, **{c: 'l' for c in _AMBIGUOUS}}),
+}
+# "!" and "|" ending a word are punctuation, not letters ("wow!!" isn't "wowii")
+_WORD_END_MARKS = re.compile(r'[!|]+(?=\s|$)')
+# Characters that are dropped outright: zero-width spaces and joiners, soft
+# hyphens and other invisible characters hidden inside words
+_INVISIBLE = re.compile('[\u00ad\u034f\u180e\u200b-\u200f\u2060-\u2064\ufeff]')
+# Whatever is left that isn't a letter, digit or whitespace: punctuation and
+# emoji separate words, like a space
+_SEPARATORS = re.compile(r'[^\w\s]|_')
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize(text: str, one: str = 'i') -> str:
+    """Fold text to the form banned words are matched in.
+
+    NFKC (fullwidth and styled letters), casefold, accents and zero-width
+    characters dropped, confusable and leet characters mapped to Latin
+    letters (1, | and ! to `one`), and punctuation and emoji turned into
+    spaces. Runs of single letters are joined, so "b a d" and "b.a.d"
+    become "bad". Cached, since floods repeat the same text.
+    """
+    if text.isascii():
+        text = text.lower()
+    else:
+        text = unicodedata.normalize('NFKC', text).casefold()
+        text = unicodedata.normalize('NFD', text)
+        text = ''.join(c for c in _INVISIBLE.sub('', text) if not unicodedata.combining(c))
+        text = text.translate(_CONFUSABLES)
+    leet = _LEET[one]
+    text = ' '.join(
+        token.translate(leet) if any(c.isalpha() for c in token) else token
+        for token in _WORD_END_MARKS.sub('', text).split()
+    )
+    text = _SEPARATORS.sub(' ', text)
+
+    tokens = []
+    spelled = False  # the last token is a run of single letters
+    for token in text.split():
+        if len(token) == 1 and spelled:
+            tokens[-1] += token
+            continue
+        tokens.append(token)
+        spelled = len(token) == 1
+    return ' '.join(tokens)
+
+
+def normalized_forms(text: str) -> Tuple[str, ...]:
+    """normalize(text), plus the reading with 1, | and ! as "l" where that differs"""
+    first = normalize(text)
+    if not any(c in text for c in _AMBIGUOUS):
+        return (first,)
+    second = normalize(text, 'l')
+    return (first,) if second == first else (first, second)
+
+
+class BannedWordMatcher:
+    """Per-chat compiled banned word matcher.
+
+    All banned words of a chat are compiled into one regex alternation that is
+    tried at every position of the message in a single scan, instead of
+    running a substring test per word. Words and messages both go through
+    normalize(), so one word also catches its obfuscated variants. As
+    before normalization, a banned word matches anywhere in the message,
+    also inside longer words:
+
+    >>> matcher = BannedWordMatcher([{'word': 'spam', 'action': 'delete'}, {'word': 'hello', 'action': 'warn'}])
+    >>> matcher.match("buy cheap $p4m now")
+    ('spam', 'delete')
+    >>> matcher.match("go.s.p.a.m")
+    ('spam', 'delete')
+    >>> matcher.match("he11o there")
+    ('hello', 'warn')
+    >>> BannedWordMatcher([{'word': 'boo', 'action': 'delete'}]).match("pay 800 now") is None
+    True
+    """
+
+    def __init__(self, words: Optional[List[Dict[str, str]]] = None):
+        self.actions: Dict[str, str] = {}  # normalized word -> action
+        self.words: Dict[str, str] = {}    # normalized word -> word as added
+        self.pattern = None
+        self.max_severity = -1
+        for entry in words or []:
+            self._add(entry['word'], entry['action'])
+        self._compile()
+
+    def _add(self, word: str, action: str) -> None:
+        key = normalize(word)
+        if not key:
+            return
+        current = self.actions.get(key)
+        # Same word (or a variant of it) added twice keeps the most severe action
+        if current is None or ACTION_SEVERITY.get(action, 0) > ACTION_SEVERITY.get(current, 0):
+            self.actions[key] = action
+            self.words[key] = word
+
+    def _compile(self) -> None:
+        if not self.actions:
+            self.pattern = None
+            self.max_severity = -1
+            return
+
+        # Most severe first, then longest first: the alternative chosen at a
+        # position is always the worst word that starts there.
+        ordered = sorted(
+            self.actions,
+            key=lambda w: (-ACTION_SEVERITY.get(self.actions[w], 0), -len(w))
+        )
+        alternation = '|'.join(re.escape(w) for w in ordered)
+        # Zero-width lookahead so overlapping hits are all visited
+        self.pattern = re.compile(f"(?=({alternation}))")
+        self.max_severity = max(ACTION_SEVERITY.get(a, 0) for a in self.actions.values())
+
+    def add(self, word: str, action: str) -> None:
+        """Add a word and recompile this chat's pattern"""
+        self._add(word, action)
+        self._compile()
+
+    def remove(self, word: str) -> None:
+        """Remove a word (and variants normalizing alike) and recompile this chat's pattern"""
+        key = normalize(word)
+        self.words.pop(key, None)
+        if self.actions.pop(key, None) is not None:
+            self._compile()
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    def match(self, text: str) -> Optional[Tuple[str, str]]:
+        """Return (word, action) of the most severe hit in text, or None"""
+        if self.pattern is None:
+            return None
+
+        best_word = None
+        best_severity = -1
+        for form in normalized_forms(text):
+            for m in self.pattern.finditer(form):
+                word = m.group(1)
+                severity = ACTION_SEVERITY.get(self.actions[word], 0)
+                if severity > best_severity:
+                    best_word = word
+                    best_severity = severity
+                    if severity >= self.max_severity:
+                        return self.words[best_word], self.actions[best_word]
+
+        if best_word is None:
+            return None
+        return self.words[best_word], self.actions[best_word]